@@ -0,0 +1,140 @@
+"""Общие утилиты для бенчмарков: загрузка модуля бота и генерация данных"""
+import os
+import sys
+import json
+import math
+import random
+import datetime
+import importlib.util
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_SOURCE = os.path.join(ROOT_DIR, "py.py")
+
+BENCH_TOKEN = "123456789:BENCHMARK-token_for-local-runs"
+BENCH_ADMIN_ID = 1000
+
+# Файлы-заглушки, на которые ссылаются сгенерированные материалы
+DUMMY_FILES = [f"bench_{i:02d}.pdf" for i in range(16)]
+
+
+def load_bot_module(workdir: str):
+    """Импорт py.py с тестовым токеном внутри рабочей директории бенчмарка.
+
+    Бот создает data/ и static/media относительно текущей директории,
+    поэтому импорт выполняется после chdir во временную папку.
+    """
+    os.environ["BOT_TOKEN"] = BENCH_TOKEN
+    os.environ["ADMIN_IDS"] = str(BENCH_ADMIN_ID)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.chdir(workdir)
+    # py.py импортирует соседний модуль charts
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+    spec = importlib.util.spec_from_file_location("welccom_bot", BOT_SOURCE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_materials(bot_module, count: int, seed: int = 42) -> dict:
+    """Сгенерировать каталог материалов, равномерно распределенный по разделам"""
+    rnd = random.Random(seed)
+    sections = []
+    for key, subject_name in bot_module.SUBJECTS.items():
+        if key == "информатика":
+            sections.extend((subject_name, group, "") for group in bot_module.INFORMATICS_GROUPS)
+        else:
+            for material_type in bot_module.SUBJECT_TYPES.get(key, ["📚 Лекции"]):
+                sections.append((subject_name, "all", material_type))
+
+    today = datetime.date.today()
+    materials = {}
+    for i in range(count):
+        subject_name, group, material_type = sections[i % len(sections)]
+        material_id = f"{i:08x}"
+        materials[material_id] = {
+            "id": material_id,
+            "title": f"Материал {i}",
+            "subject": subject_name,
+            "group": group,
+            "material_type": material_type,
+            "description": f"Описание материала {i}",
+            "file_path": DUMMY_FILES[i % len(DUMMY_FILES)],
+            "date_added": (today - datetime.timedelta(days=rnd.randrange(365))).isoformat(),
+        }
+    return materials
+
+
+def generate_statistics(materials: dict, users: int, days: int = 30, seed: int = 42) -> dict:
+    """Сгенерировать статистику в формате Statistics.data"""
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    material_ids = list(materials)
+    action_types = ["start_command", "all_materials_view", "subject_view", "material_view", "main_menu"]
+
+    data = {
+        "total_users": users,
+        "active_users": [str(100000 + i) for i in range(users)],
+        "daily_stats": {},
+        "material_views": {},
+        "subject_views": {},
+        "user_actions": {},
+    }
+
+    for offset in range(days):
+        date_str = (today - datetime.timedelta(days=offset)).isoformat()
+        active = rnd.sample(data["active_users"], min(users, max(1, users // 10)))
+        data["daily_stats"][date_str] = {
+            "new_users": len(active) // 5,
+            "active_users": active,
+            "actions": len(active) * 3,
+        }
+
+    for material_id in material_ids:
+        data["material_views"][material_id] = rnd.randrange(1000)
+
+    for user_id in data["active_users"]:
+        first_seen = today - datetime.timedelta(days=rnd.randrange(days))
+        counts = {action: rnd.randrange(1, 20) for action in rnd.sample(action_types, 3)}
+        data["user_actions"][user_id] = {
+            "first_seen": first_seen.isoformat(),
+            "last_seen": (first_seen + datetime.timedelta(days=rnd.randrange(days))).isoformat(),
+            "total_actions": sum(counts.values()),
+            "action_types": counts,
+        }
+    return data
+
+
+def write_dataset(bot_module, materials: dict, statistics_data: dict = None):
+    """Записать каталог и файлы-заглушки в рабочую директорию бота"""
+    os.makedirs(bot_module.MEDIA_DIR, exist_ok=True)
+    for file_name in DUMMY_FILES:
+        path = os.path.join(bot_module.MEDIA_DIR, file_name)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(os.urandom(1024))
+
+    bot_module.DataManager.save_json(materials, bot_module.MATERIALS_FILE)
+    if statistics_data is not None:
+        bot_module.DataManager.save_json(statistics_data, bot_module.STATS_FILE)
+        # Статистика загружается при импорте, перечитываем ее
+        bot_module.statistics.data = bot_module.statistics.load_data()
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Перцентиль по отсортированной выборке (метод ближайшего ранга)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def dump_report(report: dict, path: str = None):
+    """Вывести отчет и при необходимости сохранить его в JSON"""
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
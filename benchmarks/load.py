@@ -0,0 +1,382 @@
+"""Нагрузочный бенчмарк бота против локальной заглушки Telegram Bot API.
+
+Поднимает aiohttp-сервер, имитирующий Bot API, направляет на него бота и
+запускает синтетических пользователей, которые проходят путь
+/start → предмет → группа/тип → материал. В конце печатает updates/sec,
+p50/p99 задержки обработчиков и пиковый RSS процесса.
+
+Пример:
+    python benchmarks/load.py --materials 10000 --users 200 --rounds 3
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import (  # noqa: E402
+    BENCH_TOKEN, load_bot_module, generate_materials, generate_statistics,
+    write_dataset, percentile, dump_report,
+)
+
+BOT_USER_ID = int(BENCH_TOKEN.split(":")[0])
+FIRST_USER_ID = 500000
+
+
+class FakeBotAPI:
+    """Минимальная заглушка Bot API: getUpdates, отправка и редактирование сообщений"""
+
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chats: dict = {}
+        self.api_calls = 0
+        self.calls_by_method: dict = {}
+
+    def chat_queue(self, chat_id: int) -> asyncio.Queue:
+        if chat_id not in self.chats:
+            self.chats[chat_id] = asyncio.Queue()
+        return self.chats[chat_id]
+
+    def push_update(self, payload: dict):
+        payload["update_id"] = next(self.update_ids)
+        self.updates.put_nowait(payload)
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _message(self, chat_id: int, message_id: int = None, **fields) -> dict:
+        message = {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_USER_ID, "is_bot": True, "first_name": "Bench"},
+        }
+        message.update(fields)
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        self.api_calls += 1
+        self.calls_by_method[method] = self.calls_by_method.get(method, 0) + 1
+
+        if method == "getupdates":
+            result = await self._get_updates(form)
+        elif method == "getme":
+            result = {"id": BOT_USER_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self._record_output(method, form)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, form) -> list:
+        timeout = float(form.get("timeout", 0) or 0)
+        limit = int(form.get("limit", 100) or 100)
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01))
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    def _record_output(self, method: str, form) -> object:
+        chat_id = int(form["chat_id"])
+        markup = json.loads(form["reply_markup"]) if form.get("reply_markup") else None
+        fields = {}
+        if "text" in form:
+            fields["text"] = form["text"]
+        if "caption" in form:
+            fields["caption"] = form["caption"]
+        if markup:
+            fields["reply_markup"] = markup
+
+        file_ref = {"file_id": f"bench-{method}", "file_unique_id": f"bench-{method}"}
+        if method == "senddocument":
+            fields["document"] = file_ref
+        elif method == "sendphoto":
+            fields["photo"] = [dict(file_ref, width=100, height=100)]
+        elif method == "sendvideo":
+            fields["video"] = dict(file_ref, width=100, height=100, duration=1)
+        elif method == "sendsticker":
+            fields["sticker"] = dict(file_ref, type="regular", width=512, height=512,
+                                     is_animated=False, is_video=False)
+        elif method == "editmessagemedia":
+            media = json.loads(form["media"])
+            if media.get("caption"):
+                fields["caption"] = media["caption"]
+            if media["type"] == "photo":
+                fields["photo"] = [dict(file_ref, width=100, height=100)]
+            elif media["type"] == "video":
+                fields["video"] = dict(file_ref, width=100, height=100, duration=1)
+            else:
+                fields["document"] = file_ref
+
+        if method == "sendmediagroup":
+            media = json.loads(form["media"])
+            result = [self._message(chat_id, document=file_ref) for _ in media]
+        else:
+            message_id = int(form["message_id"]) if form.get("message_id") else None
+            result = self._message(chat_id, message_id, **fields)
+
+        self.chat_queue(chat_id).put_nowait((method, result))
+        return result
+
+
+class SyntheticUser:
+    """Пользователь, который проходит сценарий навигации до материала"""
+
+    def __init__(self, api: FakeBotAPI, user_id: int, rnd: random.Random, step_timeout: float):
+        self.api = api
+        self.user_id = user_id
+        self.rnd = rnd
+        self.step_timeout = step_timeout
+        self.inbox = api.chat_queue(user_id)
+        self.screen = None
+        self.completed = 0
+        self.failed = 0
+
+    def _user(self) -> dict:
+        return {"id": self.user_id, "is_bot": False, "first_name": f"Student{self.user_id}"}
+
+    async def _wait_for(self, predicate):
+        deadline = time.perf_counter() + self.step_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            method, message = await asyncio.wait_for(self.inbox.get(), timeout=remaining)
+            if predicate(method, message):
+                return message
+
+    @staticmethod
+    def _has_keyboard(method, message) -> bool:
+        return isinstance(message, dict) and "reply_markup" in message
+
+    def _send_command(self, text: str):
+        self.api.push_update({
+            "message": {
+                "message_id": next(self.api.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": self._user(),
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            }
+        })
+
+    def _tap(self, callback_data: str):
+        self.api.push_update({
+            "callback_query": {
+                "id": f"{self.user_id}-{time.perf_counter_ns()}",
+                "from": self._user(),
+                "chat_instance": str(self.user_id),
+                "data": callback_data,
+                "message": {
+                    "message_id": self.screen["message_id"],
+                    "date": int(time.time()),
+                    "chat": {"id": self.user_id, "type": "private"},
+                    "from": {"id": BOT_USER_ID, "is_bot": True, "first_name": "Bench"},
+                    "text": self.screen.get("text", ""),
+                },
+            }
+        })
+
+    def _buttons(self, prefix: str) -> list:
+        keyboard = self.screen.get("reply_markup", {}).get("inline_keyboard", [])
+        return [
+            button["callback_data"]
+            for row in keyboard for button in row
+            if button.get("callback_data", "").startswith(prefix)
+        ]
+
+    async def _navigate(self, prefixes: tuple) -> bool:
+        for prefix in prefixes:
+            options = self._buttons(prefix)
+            if not options:
+                return False
+            self._tap(self.rnd.choice(options))
+            self.screen = await self._wait_for(self._has_keyboard)
+        return True
+
+    async def run(self, rounds: int):
+        try:
+            self._send_command("/start")
+            self.screen = await self._wait_for(self._has_keyboard)
+            for _ in range(rounds):
+                if not await self._navigate(("all_materials", "subject:", ("group:", "material_type:"))):
+                    self.failed += 1
+                    continue
+                options = self._buttons("material:")
+                if not options:
+                    self.failed += 1
+                    continue
+                self._tap(self.rnd.choice(options))
+                await self._wait_for(
+                    lambda method, _: method in ("senddocument", "sendphoto", "sendvideo", "editmessagemedia")
+                )
+                self.completed += 1
+                await self._return_to_menu()
+        except asyncio.TimeoutError:
+            self.failed += 1
+
+    async def _return_to_menu(self):
+        self._send_command("/menu")
+        self.screen = await self._wait_for(self._has_keyboard)
+
+
+class LatencyMiddleware:
+    """Замер времени обработки каждого апдейта диспетчером"""
+
+    def __init__(self):
+        self.samples = []
+        self.first = None
+        self.last = None
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        if self.first is None:
+            self.first = started
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.perf_counter()
+            self.samples.append(finished - started)
+            self.last = finished
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+async def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="welccom-load-")
+    if args.inline_media:
+        os.environ["MATERIAL_INLINE_MEDIA"] = "1"
+    if not args.throttle:
+        # Синтетические пользователи нажимают кнопки без пауз — ограничение частоты исказило бы замер
+        for budget in ("NAVIGATION", "FILES", "ADMIN"):
+            os.environ.setdefault(f"THROTTLE_{budget}", "1000000:1000000")
+    bot_module = load_bot_module(workdir)
+
+    from aiogram.client.telegram import TelegramAPIServer
+
+    materials = generate_materials(bot_module, args.materials, seed=args.seed)
+    stats = generate_statistics(materials, args.existing_users, seed=args.seed) if args.existing_users else None
+    write_dataset(bot_module, materials, stats)
+    rss_before = _peak_rss_mb()
+
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.build_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    bot = bot_module.bot
+    await bot.session.close()
+    bot.session = bot_module.TunedAiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+
+    latency = LatencyMiddleware()
+    bot_module.dp.update.outer_middleware(latency)
+
+    polling = asyncio.create_task(
+        bot_module.dp.start_polling(bot, handle_signals=False, polling_timeout=1)
+    )
+
+    rnd = random.Random(args.seed)
+    users = [
+        SyntheticUser(api, FIRST_USER_ID + i, random.Random(rnd.random()), args.step_timeout)
+        for i in range(args.users)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*(user.run(args.rounds) for user in users))
+    wall = time.perf_counter() - started
+
+    await bot_module.dp.stop_polling()
+    await polling
+    await runner.cleanup()
+
+    samples = latency.samples
+    busy = (latency.last - latency.first) if samples and latency.last else wall
+    return {
+        "materials": args.materials,
+        "users": args.users,
+        "rounds": args.rounds,
+        "updates": len(samples),
+        "updates_per_sec": round(len(samples) / busy, 1) if busy else 0.0,
+        "handler_p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "handler_p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "handler_max_ms": round(max(samples) * 1000, 2) if samples else 0.0,
+        "api_calls": api.api_calls,
+        "api_calls_by_method": dict(sorted(api.calls_by_method.items())),
+        "flows_completed": sum(user.completed for user in users),
+        "flows_failed": sum(user.failed for user in users),
+        "wall_time_sec": round(wall, 2),
+        "rss_after_dataset_mb": round(rss_before, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "workdir": workdir,
+        "bot_metrics": bot_module.metrics.snapshot() if hasattr(bot_module, "metrics") else {},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк бота учебных материалов")
+    parser.add_argument("--materials", type=int, default=1000, help="размер каталога")
+    parser.add_argument("--users", type=int, default=100, help="число синтетических пользователей")
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз каждый пользователь открывает материал")
+    parser.add_argument("--existing-users", type=int, default=0, help="пользователей в уже накопленной статистике")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=0, help="порт заглушки Bot API (0 — любой свободный)")
+    parser.add_argument("--step-timeout", type=float, default=30.0, help="таймаут одного шага сценария, сек")
+    parser.add_argument("--inline-media", action="store_true", help="карточка материала через edit_message_media")
+    parser.add_argument("--throttle", action="store_true", help="оставить ограничение частоты действий пользователей")
+    parser.add_argument("--json", dest="json_path", help="сохранить отчет в JSON-файл")
+    parser.add_argument("--min-updates-per-sec", type=float, help="порог пропускной способности")
+    parser.add_argument("--max-p99-ms", type=float, help="порог p99 задержки обработчика")
+    parser.add_argument("--max-rss-mb", type=float, help="порог пикового RSS")
+    return parser.parse_args(argv)
+
+
+def check_thresholds(report: dict, args) -> list:
+    problems = []
+    if report["flows_failed"]:
+        problems.append(f"незавершенных сценариев: {report['flows_failed']}")
+    if args.min_updates_per_sec is not None and report["updates_per_sec"] < args.min_updates_per_sec:
+        problems.append(f"updates/sec {report['updates_per_sec']} < {args.min_updates_per_sec}")
+    if args.max_p99_ms is not None and report["handler_p99_ms"] > args.max_p99_ms:
+        problems.append(f"p99 {report['handler_p99_ms']} мс > {args.max_p99_ms} мс")
+    if args.max_rss_mb is not None and report["peak_rss_mb"] > args.max_rss_mb:
+        problems.append(f"RSS {report['peak_rss_mb']} МБ > {args.max_rss_mb} МБ")
+    return problems
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+    dump_report(report, args.json_path)
+
+    problems = check_thresholds(report, args)
+    for problem in problems:
+        print(f"❌ Регрессия: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Микробенчмарки слоя хранения с порогами регрессии.
+
+Замеряет запросы MaterialManager, сериализацию Material и каталога, методы Statistics и
+построение клавиатур на сгенерированных наборах данных. Результаты
+сравниваются с сохраненным baseline: если операция стала медленнее порога,
+скрипт завершается с кодом 1.
+
+Примеры:
+    python benchmarks/storage.py --save-baseline
+    python benchmarks/storage.py --sizes 1000,10000 --threshold 0.3
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import (  # noqa: E402
+    BENCH_ADMIN_ID, load_bot_module, generate_materials, generate_statistics, write_dataset,
+)
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def _label(size: int) -> str:
+    return f"{size // 1000}k" if size >= 1000 else str(size)
+
+
+def measure(func, min_time: float, repeat: int) -> float:
+    """Время одного вызова в секундах: минимум из repeat серий длительностью ~min_time"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def material_cases(bot, size: int, rnd: random.Random) -> dict:
+    """Кейсы, зависящие от размера каталога"""
+    materials = generate_materials(bot, size, seed=size)
+    write_dataset(bot, materials)
+    manager = bot.material_manager
+    ids = list(materials)
+    sample = [materials[material_id] for material_id in rnd.sample(ids, min(1000, len(ids)))]
+    objects = [bot.Material.from_dict(data) for data in sample]
+    informatics = bot.SUBJECTS["информатика"]
+    architecture = bot.SUBJECTS["архитектура"]
+    # Telegram принимает не более 100 кнопок в клавиатуре
+    section = manager.get_materials_by_subject_and_group(informatics, "11")[:100]
+
+    label = _label(size)
+    return {
+        f"material_manager.get_all_materials[{label}]": manager.get_all_materials,
+        f"material_manager.get_material[{label}]": lambda: manager.get_material(rnd.choice(ids)),
+        f"material_manager.get_materials_by_subject_and_group[{label}]":
+            lambda: manager.get_materials_by_subject_and_group(informatics, rnd.choice(bot.INFORMATICS_GROUPS)),
+        f"material_manager.get_materials_by_subject_and_type[{label}]":
+            lambda: manager.get_materials_by_subject_and_type(architecture, "📚 Лекции"),
+        f"material_manager.get_recent_materials[{label}]": lambda: manager.get_recent_materials(10),
+        f"keyboard.materials_list_keyboard[{label}]":
+            lambda: bot.KeyboardManager.materials_list_keyboard(section).as_markup(),
+        # Сериализация не зависит от размера каталога, замеряем на 1000 записей
+        f"material.from_dict_x1000[{label}]": lambda: [bot.Material.from_dict(data) for data in sample],
+        f"material.to_dict_x1000[{label}]": lambda: [material.to_dict() for material in objects],
+        f"data_manager.load_json[{label}]": lambda: bot.DataManager.load_json(bot.MATERIALS_FILE),
+        f"material_manager.save_materials[{label}]": lambda: manager.save_materials(materials),
+    }
+
+
+def statistics_cases(bot, users: int, rnd: random.Random) -> dict:
+    """Кейсы статистики на накопленной истории пользователей"""
+    materials = generate_materials(bot, 10000, seed=users)
+    write_dataset(bot, materials, generate_statistics(materials, users, seed=users))
+    stats = bot.statistics
+    material_ids = list(materials)
+    user_ids = [100000 + i for i in range(users)]
+
+    label = _label(users)
+    return {
+        f"statistics.register_action[{label} users]":
+            lambda: stats.register_action(rnd.choice(user_ids), "material_view", rnd.choice(material_ids)),
+        f"statistics.get_daily_stats[{label} users]": lambda: stats.get_daily_stats(7),
+        f"statistics.get_popular_materials[{label} users]": lambda: stats.get_popular_materials(10),
+    }
+
+
+def keyboard_cases(bot) -> dict:
+    return {
+        "keyboard.main_menu": lambda: bot.KeyboardManager.main_menu(BENCH_ADMIN_ID).as_markup(),
+        "keyboard.subjects_keyboard": lambda: bot.KeyboardManager.subjects_keyboard().as_markup(),
+        "keyboard.groups_keyboard": lambda: bot.KeyboardManager.groups_keyboard("информатика").as_markup(),
+        "keyboard.stats_keyboard": lambda: bot.KeyboardManager.stats_keyboard().as_markup(),
+    }
+
+
+def run_cases(cases: dict, args, results: dict):
+    for name, func in cases.items():
+        if args.only and args.only not in name:
+            continue
+        seconds = measure(func, args.min_time, args.repeat)
+        results[name] = seconds
+        print(f"⏱ {name}: {seconds * 1000:.3f} мс")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Список регрессий относительно baseline"""
+    regressions = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        ratio = seconds / reference
+        if ratio > 1 + threshold:
+            regressions.append((name, reference, seconds, ratio))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки слоя хранения")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры каталога через запятую")
+    parser.add_argument("--users", type=int, default=100000, help="пользователей в статистике")
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность серии, сек")
+    parser.add_argument("--repeat", type=int, default=3, help="число серий")
+    parser.add_argument("--only", help="запускать только кейсы, содержащие подстроку")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="файл с эталонными результатами")
+    parser.add_argument("--save-baseline", action="store_true", help="перезаписать baseline текущими результатами")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление (0.25 = +25%%)")
+    parser.add_argument("--json", dest="json_path", help="сохранить результаты в JSON-файл")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    rnd = random.Random(42)
+    bot = load_bot_module(tempfile.mkdtemp(prefix="welccom-storage-"))
+
+    results = {}
+    run_cases(keyboard_cases(bot), args, results)
+    for size in (int(value) for value in args.sizes.split(",") if value.strip()):
+        run_cases(material_cases(bot, size, rnd), args, results)
+    if args.users:
+        run_cases(statistics_cases(bot, args.users, rnd), args, results)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "machine": platform.platform(),
+                "python": platform.python_version(),
+                "results": dict(sorted(baseline.items())),
+            }, f, indent=2, ensure_ascii=False)
+        print(f"💾 Baseline сохранен: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("⚠️ Baseline не найден, сравнение пропущено. Запустите с --save-baseline")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f).get("results", {})
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, reference, seconds, ratio in regressions:
+        print(f"❌ Регрессия {name}: {reference * 1000:.3f} мс → {seconds * 1000:.3f} мс (x{ratio:.2f})")
+    if not regressions:
+        print(f"✅ Регрессий нет (порог +{args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
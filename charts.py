@@ -0,0 +1,43 @@
+"""Отрисовка графиков статистики в процессах пула.
+
+Модуль без побочных эффектов и без зависимостей от бота: его предзагружает
+forkserver, воркеры получают render_chart по ссылке charts.render_chart.
+Бот при этом должен запускаться через main.py, иначе воркеры повторно
+выполнят py.py как __mp_main__ (см. check_worker).
+"""
+import io
+import sys
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+def check_worker():
+    """Инициализатор процесса пула: модуль бота (Bot, Statistics и остальные синглтоны) не должен выполняться в воркере"""
+    if "aiogram" in sys.modules:
+        raise RuntimeError("процесс графиков импортировал модуль бота; запускайте бота через main.py")
+
+def render_chart(spec: dict) -> bytes:
+    """PNG по подготовленным данным графика (выполняется в процессе пула)"""
+    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=110)
+    try:
+        if spec["kind"] == "bar":
+            ax.barh(spec["labels"][::-1], spec["series"][0]["values"][::-1], color="#4C72B0")
+        else:
+            for series in spec["series"]:
+                ax.plot(spec["labels"], series["values"], marker="o", label=series["name"])
+            if len(spec["series"]) > 1:
+                ax.legend(fontsize=8)
+            ax.tick_params(axis="x", rotation=45)
+            ax.set_ylim(bottom=0)
+        ax.set_title(spec["title"])
+        ax.grid(alpha=0.3)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
@@ -0,0 +1,11 @@
+"""Точка входа бота: python main.py.
+
+Модуль __main__ не должен иметь побочных эффектов: процессы пула графиков
+(forkserver/spawn) повторно выполняют его как __mp_main__, а модуль бота py
+импортируется только здесь, под проверкой __name__.
+"""
+import asyncio
+
+if __name__ == "__main__":
+    import py
+    asyncio.run(py.main())
@@ -1,36 +1,251 @@
 import os
+import io
+import sys
+import csv
+import copy
+import heapq
+import gzip
+import html
 import json
+import math
+import base64
+import mmap
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import contextvars
+import time
+import threading
+import traceback
+import shutil
+import struct
+import hashlib
+import zipfile
+import tempfile
 import datetime
 import uuid
 import asyncio
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
 from typing import Dict, List, Optional
 from dotenv import load_dotenv
+from aiohttp import ClientConnectorError, ClientTimeout
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, SimpleFilesPathWrapper, BareFilesPathWrapper
 from aiogram.enums import ParseMode
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramBadRequest
+from aiogram.types import (
+    Message, CallbackQuery, FSInputFile, BufferedInputFile, InputFile,
+    InputMediaDocument, InputMediaPhoto, InputMediaVideo, Update
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command, StateFilter
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram import Router
 
+import charts
+
+# Необязательные зависимости. Без msgpack снимок статистики пишется компактным JSON (кодек 0);
+# снимок, записанный с msgpack, на хосте без пакета не читается и откладывается как .corrupt-<время>
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 # Загрузка конфиденциальных данных
 env_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(env_path)
 
+# Логирование: записи уходят в очередь, в консоль их пишет отдельный поток
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json или text
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))  # доля частых debug-записей
+
+log_context = contextvars.ContextVar("log_context", default={})
+
+class LogContextFilter(logging.Filter):
+    """Переносит update_id/user_id/handler из контекста апдейта в запись до постановки в очередь"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("update_id", "user_id", "handler", "latency_ms", "stall_ms")
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc_text:
+            entry["exc"] = exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который передает трассировку в exc_text, а не склеивает ее с сообщением"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = TracebackQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Единственная точка остановки: QueueListener.stop() не идемпотентен, atexit срабатывает и после exit(), и после main()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger("welccom")
+
+def log_sampled(message: str, *args, **kwargs):
+    """Debug-запись для частых событий (отправка каждого файла), пишется с вероятностью LOG_DEBUG_SAMPLE_RATE"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_DEBUG_SAMPLE_RATE:
+        logger.debug(message, *args, **kwargs)
+
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
-    print("❌ Токен бота не найден! Проверьте файл .env")
+    logger.critical("❌ Токен бота не найден! Проверьте файл .env")
     exit()
 
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '1862652984').split(',') if id.strip()]
 
 # Константы
 MATERIALS_FILE = "data/materials.json"
+MATERIALS_SCHEMA_VERSION = 2  # 1 — словарь материалов без обертки
 STATS_FILE = "data/statistics.json"
+STATS_SNAPSHOT_FILE = "data/statistics.snap"
 MEDIA_DIR = "static/media"
+BUNDLES_DIR = "static/bundles"
+EXPORTS_DIR = "static/exports"
+BUNDLES_INDEX_FILE = "data/bundles.json"
+QUARANTINE_DIR = "static/quarantine"
+QUARANTINE_INDEX_FILE = "data/quarantine.json"
+JOBS_FILE = "data/jobs.json"
+# Собственный сервер telegram-bot-api (например, http://localhost:8081)
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()
+BOT_API_LOCAL = bool(BOT_API_URL) and os.getenv("BOT_API_LOCAL", "1") == "1"
+# Если сервер запущен в контейнере: его рабочая папка и та же папка на хосте бота
+BOT_API_SERVER_DIR = os.getenv("BOT_API_SERVER_DIR", "")
+BOT_API_LOCAL_DIR = os.getenv("BOT_API_LOCAL_DIR", "")
+
+if BOT_API_LOCAL:
+    MAX_DOWNLOAD_SIZE = MAX_UPLOAD_SIZE = 2000 * 1024 * 1024  # лимиты локального сервера
+else:
+    MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024  # лимит скачивания файлов облачным Bot API
+    MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # лимит отправки файлов облачным Bot API
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "4"))
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", "1.0"))  # секунды ожидания остальных файлов альбома
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+MEDIA_GROUP_SIZE = 10  # максимум файлов в одном send_media_group
+SEND_ALL_INTERVAL = float(os.getenv("SEND_ALL_INTERVAL", "3"))  # пауза между пачками в одном чате
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))  # одновременно обрабатываемых апдейтов
+USER_QUEUE_LIMIT = int(os.getenv("USER_QUEUE_LIMIT", "10"))  # апдейтов одного пользователя в очереди
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "1000"))  # всего апдейтов в очереди
+# Очистка файлов, на которые не ссылается каталог
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", "3600"))  # секунды между проходами
+GC_START_DELAY = float(os.getenv("GC_START_DELAY", "60"))  # первый проход после запуска
+GC_JITTER = float(os.getenv("GC_JITTER", "300"))  # случайная добавка к времени прохода, секунды
+GC_GRACE_PERIOD = float(os.getenv("GC_GRACE_PERIOD", "3600"))  # моложе этого файл не трогаем (идет загрузка)
+GC_QUARANTINE_TTL = float(os.getenv("GC_QUARANTINE_TTL", "86400"))  # сколько файл лежит в карантине
+GC_SCAN_BATCH = int(os.getenv("GC_SCAN_BATCH", "500"))  # записей каталога за один шаг обхода
+GC_SCAN_PAUSE = float(os.getenv("GC_SCAN_PAUSE", "0.05"))  # пауза между шагами обхода
+STATS_RETENTION_DAYS = int(os.getenv("STATS_RETENTION_DAYS", "180"))  # хранить daily_stats за N дней
+STATS_PRUNE_CRON = os.getenv("STATS_PRUNE_CRON", "30 4 * * *")  # когда удалять старую дневную статистику
+# HTTP-сессия Bot API
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))  # всего открытых соединений
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))  # секунды жизни простаивающего соединения
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))  # кэш DNS, секунды
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))  # обычные JSON-вызовы
+HTTP_FILE_TIMEOUT = float(os.getenv("HTTP_FILE_TIMEOUT", "300"))  # загрузка и скачивание файлов
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))  # базовая задержка, растет вдвое
+COHORT_WEEKS = int(os.getenv("COHORT_WEEKS", "6"))  # сколько недельных когорт и недель удержания показывать
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))  # процессов для отрисовки графиков
+# Карточка материала превращается в сообщение с файлом (edit_message_media) вместо текста + второго сообщения
+MATERIAL_INLINE_MEDIA = os.getenv("MATERIAL_INLINE_MEDIA", "0") == "1"
+MEDIA_CAPTION_LIMIT = 1024  # максимум символов подписи к файлу
+# Ограничение частоты действий пользователя: "запас:пополнение в секунду"
+THROTTLE_BUDGETS = {
+    "navigation": os.getenv("THROTTLE_NAVIGATION", "10:2"),
+    "files": os.getenv("THROTTLE_FILES", "3:0.2"),
+    "admin": os.getenv("THROTTLE_ADMIN", "30:10"),
+}
+BACKGROUND_CONCURRENCY = int(os.getenv("BACKGROUND_CONCURRENCY", "16"))  # одновременно выполняемых фоновых задач
+BACKGROUND_PER_USER = int(os.getenv("BACKGROUND_PER_USER", "3"))  # фоновых задач одного пользователя
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "0.1"))  # период пульса цикла событий, секунды
+WATCHDOG_THRESHOLD = float(os.getenv("WATCHDOG_THRESHOLD", "0.5"))  # задержка пульса, после которой снимается стек (0 — выключено)
+WATCHDOG_STACK_DEPTH = int(os.getenv("WATCHDOG_STACK_DEPTH", "25"))  # кадров стека в записи о зависании
+STATS_FLUSH_DELAY = float(os.getenv("STATS_FLUSH_DELAY", "1.0"))  # интервал записи накопленных изменений статистики
+VIEW_DEDUPE_WINDOW = float(os.getenv("VIEW_DEDUPE_WINDOW", "1800"))  # повторный просмотр того же материала за это время не считается
+VIEW_DEDUPE_LIMIT = int(os.getenv("VIEW_DEDUPE_LIMIT", "100000"))  # пар пользователь/материал в окне
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "10"))  # 2^p регистров на материал, погрешность ~1.04/sqrt(2^p)
+EDIT_FINGERPRINT_LIMIT = int(os.getenv("EDIT_FINGERPRINT_LIMIT", "10000"))  # сообщений с запомненным содержимым
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "10000"))  # строк в одной порции записи экспорта
+ALLOWED_EXTENSIONS = {
+    ".pdf", ".doc", ".docx", ".ppt", ".pptx", ".xls", ".xlsx", ".odt", ".odp", ".ods",
+    ".txt", ".rtf", ".md", ".zip", ".rar", ".7z",
+    ".jpg", ".jpeg", ".png", ".gif", ".mp4", ".avi", ".mov", ".mkv",
+}
 os.makedirs("data", exist_ok=True)
 os.makedirs(MEDIA_DIR, exist_ok=True)
 
@@ -50,8 +265,79 @@ SUBJECT_TYPES = {
     "мдк": ["📚 Лекции", "📝 Практические работы"]
 }
 
+# HTTP-сессия с настроенным пулом соединений, таймаутами и повторами
+class TunedAiohttpSession(AiohttpSession):
+    # Повтор этих методов после таймаута или 5xx не создает дублей у пользователя
+    IDEMPOTENT_PREFIXES = ("get", "edit", "delete", "answer", "set")
+    # Параметры, в которых локальному серверу передается путь file://
+    FILE_FIELDS = ("photo", "video", "document", "audio", "voice", "animation", "video_note", "sticker", "thumbnail", "media")
+    
+    def __init__(self, **kwargs):
+        super().__init__(limit=HTTP_POOL_LIMIT, **kwargs)
+        self._connector_init.update(
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+        self.json_timeout = ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        self.file_timeout = ClientTimeout(total=HTTP_FILE_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    
+    def _is_upload_value(self, value) -> bool:
+        """Файл в запросе: InputFile или путь file:// для локального сервера"""
+        if isinstance(value, InputFile):
+            return True
+        return self.api.is_local and isinstance(value, str) and value.startswith("file://")
+    
+    def _is_file_transfer(self, method) -> bool:
+        """Запрос, который передает файл: загрузка или getFile (локальный сервер отвечает после скачивания файла)"""
+        if method.__api_method__ == "getFile":
+            return True
+        for name, value in method.__dict__.items():
+            if isinstance(value, InputFile) or self._is_upload_value(getattr(value, "media", None)):
+                return True
+            if name in self.FILE_FIELDS and self._is_upload_value(value):
+                return True
+            if isinstance(value, list) and any(self._is_upload_value(getattr(item, "media", None)) for item in value):
+                return True
+        return False
+    
+    @classmethod
+    def _is_idempotent(cls, api_method: str) -> bool:
+        return api_method.startswith(cls.IDEMPOTENT_PREFIXES)
+    
+    async def make_request(self, bot: Bot, method, timeout=None):
+        api_method = method.__api_method__
+        if timeout is None:
+            timeout = self.file_timeout if self._is_file_transfer(method) else self.json_timeout
+        # getUpdates повторяет сам диспетчер
+        retries = 0 if api_method == "getUpdates" else HTTP_RETRIES
+        
+        attempt = 0
+        while True:
+            try:
+                return await super().make_request(bot, method, timeout=timeout)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                # Ошибка соединения: запрос не был отправлен, повтор безопасен для любого метода
+                not_sent = isinstance(e.__cause__, ClientConnectorError)
+                # Повтор getFile после таймаута заново запускает скачивание на локальном сервере
+                timed_out = api_method == "getFile" and isinstance(e.__cause__, asyncio.TimeoutError)
+                if attempt >= retries or timed_out or not (not_sent or self._is_idempotent(api_method)):
+                    raise
+                delay = random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt)
+                attempt += 1
+                metrics.inc("http_retries")
+                logger.warning("🔁 %s: %s, повтор %s/%s через %.2f с", api_method, e.message, attempt, retries, delay)
+                await asyncio.sleep(delay)
+
 # Инициализация бота
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+api_server = None
+if BOT_API_URL:
+    if BOT_API_SERVER_DIR and BOT_API_LOCAL_DIR:
+        files_path_wrapper = SimpleFilesPathWrapper(Path(BOT_API_SERVER_DIR), Path(BOT_API_LOCAL_DIR))
+    else:
+        files_path_wrapper = BareFilesPathWrapper()
+    api_server = TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL, wrap_local_file=files_path_wrapper)
+session = TunedAiohttpSession(api=api_server) if api_server else TunedAiohttpSession()
+bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 router = Router()
 dp.include_router(router)
@@ -65,8 +351,452 @@ class AddMaterialStates(StatesGroup):
     waiting_description = State()
     waiting_file = State()
 
+class ImportStates(StatesGroup):
+    waiting_archive = State()
+
+# Метрики работы бота
+class Metrics:
+    """Счетчики и скользящие окна замеров для админского экрана"""
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.counters: Dict[str, int] = {}
+        self.samples: Dict[str, deque] = {}
+    
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name: str, value: float):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+        self.samples[name].append(value)
+    
+    def summary(self, name: str) -> dict:
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return {"count": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+        return {
+            "count": len(values),
+            "p50": values[len(values) // 2],
+            "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+            "max": values[-1],
+        }
+    
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(sorted(self.counters.items())),
+            "samples": {name: self.summary(name) for name in sorted(self.samples)},
+        }
+
+metrics = Metrics()
+
+# Фоновые задачи, которые выполняются после ответа пользователю
+class BackgroundTasks:
+    """Общий лимит, лимит на пользователя, отмена при навигации и отчет об ошибках"""
+    def __init__(self, concurrency: int, per_user: int):
+        self.concurrency = concurrency
+        self.per_user = per_user
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        self._user_tasks: Dict[int, set] = {}
+        self._cancellable = set()
+    
+    def submit(self, user_id: Optional[int], name: str, coro, cancel_on_navigation: bool = False) -> Optional[asyncio.Task]:
+        """Запустить корутину в фоне; None — у пользователя уже слишком много задач"""
+        user_tasks = self._user_tasks.setdefault(user_id, set()) if user_id is not None else None
+        if user_tasks is not None and len(user_tasks) >= self.per_user:
+            coro.close()
+            metrics.inc("background_rejected")
+            return None
+        
+        task = asyncio.create_task(self._run(user_id, name, coro), name=name)
+        self._tasks.add(task)
+        if user_tasks is not None:
+            user_tasks.add(task)
+        if cancel_on_navigation:
+            self._cancellable.add(task)
+        task.add_done_callback(lambda done: self._forget(user_id, done))
+        return task
+    
+    def _forget(self, user_id: Optional[int], task: asyncio.Task):
+        self._tasks.discard(task)
+        self._cancellable.discard(task)
+        user_tasks = self._user_tasks.get(user_id)
+        if user_tasks is not None:
+            user_tasks.discard(task)
+            if not user_tasks:
+                del self._user_tasks[user_id]
+    
+    async def _run(self, user_id: Optional[int], name: str, coro):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        try:
+            async with self._slots:
+                await coro
+            metrics.observe("background_ms", (time.perf_counter() - started) * 1000)
+        except asyncio.CancelledError:
+            metrics.inc("background_cancelled")
+            raise
+        except Exception as e:
+            metrics.inc("background_errors")
+            logger.exception("❌ Ошибка фоновой задачи %s: %s", name, e)
+            if user_id is not None:
+                try:
+                    await bot.send_message(user_id, "⚠️ Не удалось завершить действие. Попробуйте еще раз.")
+                except Exception:
+                    pass
+    
+    def cancel_user(self, user_id: int) -> int:
+        """Отменить задачи пользователя, помеченные cancel_on_navigation"""
+        cancelled = 0
+        for task in self._user_tasks.get(user_id, ()):
+            if task in self._cancellable and not task.done():
+                task.cancel()
+                cancelled += 1
+        return cancelled
+    
+    async def close(self, timeout: float = 10):
+        """Дождаться фоновых задач (не дольше timeout) и отменить оставшиеся"""
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+background = BackgroundTasks(BACKGROUND_CONCURRENCY, BACKGROUND_PER_USER)
+
+# Планировщик периодических задач
+class IntervalTrigger:
+    """Запуск раз в seconds секунд, отсчет от начала предыдущего запуска"""
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+    
+    def next_run(self, now: datetime.datetime, last_run: Optional[datetime.datetime]) -> datetime.datetime:
+        if last_run is None:
+            return now
+        return max(now, last_run + datetime.timedelta(seconds=self.seconds))
+    
+    def __str__(self):
+        return f"каждые {self.seconds:g} с"
+
+class CronTrigger:
+    """Пять полей crontab: минута, час, день месяца, месяц, день недели (0 и 7 — воскресенье)"""
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"ожидается 5 полей cron: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        # Как в cron: если заданы и день месяца, и день недели, достаточно совпадения любого
+        self.any_day = parts[2] == "*" or parts[4] == "*"
+    
+    @staticmethod
+    def _parse(part: str, low: int, high: int) -> set:
+        values = set()
+        for item in part.split(","):
+            value_range, _, step = item.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = map(int, value_range.split("-", 1))
+            else:
+                start = int(value_range)
+                end = high if step else start
+            if start < low or end > high or start > end or (step and int(step) < 1):
+                raise ValueError(f"недопустимое поле cron: {part!r}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+    
+    def _day_matches(self, day: datetime.date) -> bool:
+        day_ok = day.day in self.days
+        weekday_ok = day.isoweekday() % 7 in self.weekdays
+        return day_ok and weekday_ok if self.any_day else day_ok or weekday_ok
+    
+    def next_run(self, now: datetime.datetime, last_run: Optional[datetime.datetime]) -> datetime.datetime:
+        after = max(now, last_run) if last_run else now
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment.date()):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron {self.expression!r} никогда не срабатывает")
+    
+    def __str__(self):
+        return f"cron {self.expression}"
+
+@dataclass
+class Job:
+    name: str
+    trigger: object
+    func: object  # функция без аргументов, может быть корутинной
+    jitter: float = 0
+    start_delay: float = 0
+    persist: bool = True
+    last_run: Optional[datetime.datetime] = None
+    next_run: Optional[datetime.datetime] = None
+    running: bool = False
+    runs: int = 0
+    failures: int = 0
+    last_duration_ms: float = 0.0
+    last_error: str = ""
+
+class Scheduler:
+    """Периодические задачи в цикле событий: интервал или cron, разброс, запуски задачи не накладываются"""
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.jobs: Dict[str, Job] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._started = False
+        self._save_lock = asyncio.Lock()
+    
+    def add(self, name: str, trigger, func, jitter: float = 0, start_delay: float = 0, persist: bool = True) -> Job:
+        """Зарегистрировать задачу; persist=False — время запуска не сохраняется в JOBS_FILE"""
+        if name in self.jobs:
+            raise ValueError(f"задача {name} уже зарегистрирована")
+        # Триггер, который не может вычислить время запуска (cron без подходящих дат), отклоняется сразу
+        trigger.next_run(datetime.datetime.now(), None)
+        job = Job(name, trigger, func, jitter, start_delay, persist)
+        self.jobs[name] = job
+        if self._started:
+            self._spawn(job)
+        return job
+    
+    async def start(self):
+        state = await asyncio.to_thread(DataManager.load_json, self.state_path, {})
+        for job in self.jobs.values():
+            saved = state.get(job.name) if job.persist else None
+            if saved:
+                job.last_run = datetime.datetime.fromisoformat(saved["last_run"])
+                job.runs = saved.get("runs", 0)
+                job.failures = saved.get("failures", 0)
+                job.last_duration_ms = saved.get("last_duration_ms", 0.0)
+                job.last_error = saved.get("last_error", "")
+            self._spawn(job)
+        self._started = True
+        logger.info("🗓 Планировщик запущен: %s", ", ".join(self.jobs) or "нет задач")
+    
+    async def stop(self):
+        self._started = False
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._save_state()
+    
+    def _spawn(self, job: Job):
+        self._tasks[job.name] = asyncio.create_task(self._loop(job), name=f"job:{job.name}")
+    
+    def _next_run(self, job: Job, first: bool = False) -> datetime.datetime:
+        now = datetime.datetime.now()
+        moment = job.trigger.next_run(now, job.last_run)
+        if first:
+            moment = max(moment, now + datetime.timedelta(seconds=job.start_delay))
+        if job.jitter:
+            moment += datetime.timedelta(seconds=random.uniform(0, job.jitter))
+        return moment
+    
+    async def _loop(self, job: Job):
+        try:
+            job.next_run = self._next_run(job, first=True)
+            while True:
+                delay = (job.next_run - datetime.datetime.now()).total_seconds()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.run(job.name)
+                job.next_run = self._next_run(job)
+        except Exception as e:
+            # Ошибки самой задачи перехватывает run(); сюда попадает только сбой расписания
+            job.next_run = None
+            job.last_error = f"{type(e).__name__}: {e}"
+            metrics.inc(f"job_{job.name}_errors")
+            logger.exception("❌ Задача %s снята с расписания: %s", job.name, e)
+    
+    async def run(self, name: str) -> bool:
+        """Выполнить задачу сейчас; False — предыдущий запуск еще не завершился"""
+        job = self.jobs[name]
+        if job.running:
+            metrics.inc("jobs_skipped")
+            logger.warning("⏭ Задача %s еще выполняется, запуск пропущен", name)
+            return False
+        job.running = True
+        job.last_run = datetime.datetime.now()
+        started = time.perf_counter()
+        try:
+            result = job.func()
+            if asyncio.iscoroutine(result):
+                await result
+            job.last_error = ""
+        except Exception as e:
+            job.failures += 1
+            job.last_error = f"{type(e).__name__}: {e}"
+            metrics.inc(f"job_{name}_errors")
+            logger.exception("❌ Ошибка задачи %s: %s", name, e)
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            metrics.observe(f"job_{name}_ms", job.last_duration_ms)
+        if job.persist:
+            await self._save_state()
+        return True
+    
+    async def _save_state(self):
+        state = {
+            job.name: {
+                "last_run": job.last_run.isoformat(timespec="seconds"),
+                "runs": job.runs,
+                "failures": job.failures,
+                "last_duration_ms": job.last_duration_ms,
+                "last_error": job.last_error,
+            }
+            for job in self.jobs.values() if job.persist and job.last_run
+        }
+        async with self._save_lock:
+            await asyncio.to_thread(DataManager.save_json, state, self.state_path, False)
+
+scheduler = Scheduler(JOBS_FILE)
+dp.startup.register(scheduler.start)
+dp.shutdown.register(scheduler.stop)
+
+# Сторож цикла событий: находит код, который надолго блокирует цикл
+class StallWatchdog:
+    """Пульс в цикле событий и поток-наблюдатель: при зависании снимается стек цикла и текущий апдейт"""
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        # Задача -> апдейт, который она обрабатывает (update_id, user_id, handler)
+        self.in_flight: Dict[asyncio.Task, dict] = {}
+        self.last_stall: Optional[dict] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        self._captured_beat = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+    
+    def enter(self, info: dict) -> Optional[asyncio.Task]:
+        task = asyncio.current_task()
+        if task is not None:
+            self.in_flight[task] = info
+        return task
+    
+    def annotate(self, **fields):
+        info = self.in_flight.get(asyncio.current_task())
+        if info is not None:
+            info.update(fields)
+    
+    def leave(self, task: Optional[asyncio.Task]):
+        if task is not None:
+            self.in_flight.pop(task, None)
+    
+    async def start(self):
+        if self.threshold <= 0 or self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop_event.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="watchdog_heartbeat")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+    
+    async def stop(self):
+        self._stop_event.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+    
+    async def _heartbeat(self):
+        while True:
+            beat = self._beat
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            lag_ms = round((now - beat - self.interval) * 1000, 1)
+            metrics.observe("loop_lag_ms", lag_ms)
+            if lag_ms >= self.threshold * 1000:
+                metrics.inc("loop_stalls")
+                metrics.observe("loop_stall_ms", lag_ms)
+                if self.last_stall is not None and self.last_stall["beat"] == beat:
+                    self.last_stall["stall_ms"] = lag_ms
+                logger.warning("🐢 Цикл событий был заблокирован %.0f мс", lag_ms, extra={"stall_ms": lag_ms})
+    
+    def _watch(self):
+        """Поток-наблюдатель: не зависит от цикла событий, поэтому видит зависание, пока оно длится"""
+        while not self._stop_event.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled >= self.threshold and self._captured_beat != beat:
+                self._captured_beat = beat
+                try:
+                    self._capture(beat, stalled)
+                except Exception as e:
+                    logger.error("❌ Ошибка сторожа цикла событий: %s", e)
+    
+    def _capture(self, beat: float, stalled: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame, limit=WATCHDOG_STACK_DEPTH))
+        # Ближайший к вершине стека кадр бота: блокирующий код обычно вызван из него
+        own = frame
+        while own is not None and own.f_code.co_filename != __file__:
+            own = own.f_back
+        where = f"{os.path.basename(own.f_code.co_filename)}:{own.f_lineno} {own.f_code.co_name}" if own else "?"
+        
+        task = asyncio.current_task(self._loop)
+        info = dict(self.in_flight.get(task, {})) if task is not None else {}
+        stall_ms = round(stalled * 1000, 1)
+        self.last_stall = {
+            "beat": beat,
+            "at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "stall_ms": stall_ms,
+            "where": where,
+            "task": task.get_name() if task is not None else None,
+            "handler": info.get("handler"),
+            "update_id": info.get("update_id"),
+            "user_id": info.get("user_id"),
+        }
+        self._loop.call_soon_threadsafe(metrics.inc, "loop_stalls_captured")
+        logger.warning(
+            "🐢 Цикл событий заблокирован уже %.0f мс: %s (задача %s)\n%s",
+            stall_ms, where, self.last_stall["task"], stack,
+            extra={
+                "stall_ms": stall_ms,
+                "handler": info.get("handler"),
+                "update_id": info.get("update_id"),
+                "user_id": info.get("user_id"),
+            }
+        )
+
+watchdog = StallWatchdog(WATCHDOG_INTERVAL, WATCHDOG_THRESHOLD)
+dp.startup.register(watchdog.start)
+dp.shutdown.register(watchdog.stop)
+
 # Модели данных
 class Material:
+    """Запись каталога; экземпляры кэшируются MaterialManager и разделяются между запросами — не изменять"""
+    __slots__ = ("id", "title", "subject", "group", "material_type", "description", "file_path", "date_added")
+    
     def __init__(self, material_id: str, title: str, subject: str, group: str = "", material_type: str = "", description: str = "", 
                  file_path: str = None, date_added: str = None):
         self.id = material_id
@@ -93,68 +823,466 @@ class Material:
     @classmethod
     def from_dict(cls, data):
         return cls(
-            material_id=data["id"],
-            title=data["title"],
-            subject=data["subject"],
-            group=data.get("group", ""),
-            material_type=data.get("material_type", ""),
-            description=data.get("description", ""),
-            file_path=data.get("file_path"),
-            date_added=data.get("date_added")
+            data["id"],
+            data["title"],
+            data["subject"],
+            data.get("group", ""),
+            data.get("material_type", ""),
+            data.get("description", ""),
+            data.get("file_path"),
+            data.get("date_added")
         )
 
+# Компактный бинарный снимок статистики
+class StatsSnapshot:
+    """Версионированный формат: заголовок + компактный payload.
+
+    msgpack используется, если пакет установлен, иначе JSON без отступов. Кодек записан
+    в заголовке, поэтому JSON-снимок читается везде, а msgpack-снимок — только с пакетом.
+    """
+    MAGIC = b"WSTATS"
+    VERSION = 1
+    CODEC_JSON = 0
+    CODEC_MSGPACK = 1
+    HEADER = struct.Struct("<6sBBQ")  # magic, версия, кодек, длина payload
+
+    @classmethod
+    def encode(cls, data: dict) -> bytes:
+        if msgpack is not None:
+            codec = cls.CODEC_MSGPACK
+            payload = msgpack.packb(data, use_bin_type=True)
+        else:
+            codec = cls.CODEC_JSON
+            payload = DataManager.dumps(data)
+        return cls.HEADER.pack(cls.MAGIC, cls.VERSION, codec, len(payload)) + payload
+
+    @classmethod
+    def decode(cls, buffer) -> dict:
+        magic, version, codec, length = cls.HEADER.unpack_from(buffer, 0)
+        if magic != cls.MAGIC:
+            raise ValueError("неверная сигнатура снимка")
+        if version > cls.VERSION:
+            raise ValueError(f"неподдерживаемая версия снимка: {version}")
+
+        payload = memoryview(buffer)[cls.HEADER.size:cls.HEADER.size + length]
+        try:
+            if len(payload) != length:
+                raise ValueError("снимок обрезан")
+            if codec == cls.CODEC_MSGPACK:
+                if msgpack is None:
+                    raise ValueError("для чтения снимка нужен пакет msgpack")
+                return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+            if codec == cls.CODEC_JSON:
+                return DataManager.loads(payload)
+            raise ValueError(f"неизвестный кодек снимка: {codec}")
+        finally:
+            payload.release()
+
+    @classmethod
+    def load(cls, file_path: str) -> dict:
+        """Чтение снимка через mmap без промежуточной копии файла"""
+        with open(file_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return cls.decode(buffer)
+
+    @classmethod
+    def save(cls, data: dict, file_path: str):
+        cls.write(cls.encode(data), file_path)
+    
+    @staticmethod
+    def write(payload: bytes, file_path: str):
+        """Атомарная запись: временный файл + замена"""
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, file_path)
+
+# Колоночная таблица активности пользователей
+class UserTable:
+    """Строка на пользователя в массивах: id, дни первого и последнего визита (от 1970-01-01), число действий.
+    Типы действий интернируются: на каждый тип — столбец счетчиков, растущий до последней строки с этим действием.
+    Поиск строки — двоичный по отсортированной копии id, без словаря из объектов int"""
+    EPOCH = datetime.date(1970, 1, 1).toordinal()
+    
+    def __init__(self):
+        self._index_ids = array("q")
+        self._index_rows = array("i")
+        self.user_ids = array("q")
+        self.first_seen = array("i")
+        self.last_seen = array("i")
+        self.total_actions = array("I")
+        self.action_names: List[str] = []
+        self.action_ids: Dict[str, int] = {}
+        self.action_counts: List[array] = []
+    
+    def __len__(self):
+        return len(self.user_ids)
+    
+    def __contains__(self, user_id: int):
+        return self.find(user_id) is not None
+    
+    def find(self, user_id: int) -> Optional[int]:
+        position = bisect_left(self._index_ids, user_id)
+        if position < len(self._index_ids) and self._index_ids[position] == user_id:
+            return self._index_rows[position]
+        return None
+    
+    def _append(self, user_id: int, day: int) -> int:
+        """Новая строка без обновления индекса"""
+        row = len(self.user_ids)
+        self.user_ids.append(user_id)
+        self.first_seen.append(day)
+        self.last_seen.append(day)
+        self.total_actions.append(0)
+        return row
+    
+    def _reindex(self):
+        order = sorted(range(len(self.user_ids)), key=self.user_ids.__getitem__)
+        self._index_ids = array("q", (self.user_ids[row] for row in order))
+        self._index_rows = array("i", order)
+    
+    @classmethod
+    def day(cls, date_str: str) -> int:
+        return datetime.date.fromisoformat(date_str).toordinal() - cls.EPOCH
+    
+    @classmethod
+    def date(cls, day: int) -> str:
+        return datetime.date.fromordinal(day + cls.EPOCH).isoformat()
+    
+    def action_id(self, action_type: str) -> int:
+        action_id = self.action_ids.get(action_type)
+        if action_id is None:
+            action_id = self.action_ids[action_type] = len(self.action_names)
+            self.action_names.append(action_type)
+            self.action_counts.append(array("I"))
+        return action_id
+    
+    def _column(self, action_type: str, row: int) -> array:
+        """Столбец счетчиков типа действия, дополненный нулями до строки row"""
+        column = self.action_counts[self.action_id(action_type)]
+        if len(column) <= row:
+            column.frombytes(bytes(column.itemsize * (row + 1 - len(column))))
+        return column
+    
+    def ensure(self, user_id: int, day: int) -> int:
+        """Номер строки пользователя; новая строка получает первый визит day"""
+        position = bisect_left(self._index_ids, user_id)
+        if position < len(self._index_ids) and self._index_ids[position] == user_id:
+            return self._index_rows[position]
+        row = self._append(user_id, day)
+        self._index_ids.insert(position, user_id)
+        self._index_rows.insert(position, row)
+        return row
+    
+    def add_action(self, user_id: int, day: int, action_type: str):
+        row = self.ensure(user_id, day)
+        self.last_seen[row] = day
+        self.total_actions[row] += 1
+        self._column(action_type, row)[row] += 1
+    
+    def record(self, row: int) -> dict:
+        """Строка в прежнем виде записи user_actions"""
+        return {
+            "first_seen": self.date(self.first_seen[row]),
+            "last_seen": self.date(self.last_seen[row]),
+            "total_actions": self.total_actions[row],
+            "action_types": {
+                name: column[row]
+                for name, column in zip(self.action_names, self.action_counts)
+                if row < len(column) and column[row]
+            },
+        }
+    
+    def get(self, user_id: int) -> Optional[dict]:
+        row = self.find(user_id)
+        return self.record(row) if row is not None else None
+    
+    def top(self, limit: int) -> List[tuple]:
+        """(user_id, запись) самых активных пользователей"""
+        rows = heapq.nlargest(limit, range(len(self)), key=self.total_actions.__getitem__)
+        return [(self.user_ids[row], self.record(row)) for row in rows]
+    
+    def columns(self) -> dict:
+        """Копии столбцов для расчетов в потоке (цикл событий продолжает дописывать строки)"""
+        return {
+            "user_ids": self.user_ids[:],
+            "first_seen": self.first_seen[:],
+            "last_seen": self.last_seen[:],
+            "total_actions": self.total_actions[:],
+        }
+    
+    @staticmethod
+    def _pack(values: array) -> str:
+        """Столбец в base64, порядок байт в снимке — little-endian"""
+        if sys.byteorder == "big":
+            values = values[:]
+            values.byteswap()
+        return base64.b64encode(values.tobytes()).decode("ascii")
+    
+    @staticmethod
+    def _unpack(typecode: str, packed: str) -> array:
+        values = array(typecode)
+        values.frombytes(base64.b64decode(packed))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+    
+    def to_dict(self) -> dict:
+        return {
+            "user_ids": self._pack(self.user_ids),
+            "first_seen": self._pack(self.first_seen),
+            "last_seen": self._pack(self.last_seen),
+            "total_actions": self._pack(self.total_actions),
+            "actions": {name: self._pack(column) for name, column in zip(self.action_names, self.action_counts)},
+        }
+    
+    @classmethod
+    def from_dict(cls, payload: dict) -> "UserTable":
+        table = cls()
+        table.user_ids = cls._unpack("q", payload["user_ids"])
+        table.first_seen = cls._unpack("i", payload["first_seen"])
+        table.last_seen = cls._unpack("i", payload["last_seen"])
+        table.total_actions = cls._unpack("I", payload["total_actions"])
+        table._reindex()
+        for name, packed in payload["actions"].items():
+            table.action_counts[table.action_id(name)] = cls._unpack("I", packed)
+        return table
+    
+    @classmethod
+    def from_data(cls, data: dict) -> "UserTable":
+        """Извлечь таблицу из данных снимка; старые user_actions и active_users конвертируются"""
+        if "user_table" in data:
+            data.pop("user_actions", None)
+            data.pop("active_users", None)
+            return cls.from_dict(data.pop("user_table"))
+        
+        table = cls()
+        days = {}
+        for user_id, user_stats in data.pop("user_actions", {}).items():
+            for date_str in (user_stats["first_seen"], user_stats["last_seen"]):
+                if date_str not in days:
+                    days[date_str] = cls.day(date_str)
+            row = table._append(int(user_id), days[user_stats["first_seen"]])
+            table.last_seen[row] = days[user_stats["last_seen"]]
+            table.total_actions[row] = user_stats["total_actions"]
+            for action_type, count in user_stats["action_types"].items():
+                table._column(action_type, row)[row] = count
+        table._reindex()
+        # Пользователи без записи действий (регистрация без действий)
+        today = cls.day(datetime.date.today().isoformat())
+        for user_id in data.pop("active_users", ()):
+            table.ensure(int(user_id), today)
+        return table
+
+# Окно повторных просмотров: пара (пользователь, материал) живет VIEW_DEDUPE_WINDOW секунд
+class ViewDedupe:
+    def __init__(self, window: float, limit: int):
+        self.window = window
+        self.limit = limit
+        # (user_id, material_id) -> время засчитанного просмотра; порядок — по времени
+        self._entries: "OrderedDict[tuple, float]" = OrderedDict()
+    
+    def _expire(self, now: float):
+        while self._entries:
+            seen_at = next(iter(self._entries.values()))
+            if now - seen_at < self.window and len(self._entries) < self.limit:
+                break
+            self._entries.popitem(last=False)
+    
+    def seen(self, user_id: int, material_id: str) -> bool:
+        """True — пользователь уже открывал материал в окне; иначе просмотр запоминается"""
+        now = time.monotonic()
+        self._expire(now)
+        key = (user_id, material_id)
+        if key in self._entries:
+            return True
+        self._entries[key] = now
+        return False
+
+# Оценка числа уникальных зрителей материала
+class HyperLogLog:
+    """Пока зрителей мало — точный отсортированный массив 64-битных хэшей,
+    после 2^p / 8 хэшей — 2^p однобайтовых регистров HyperLogLog"""
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.hashes: Optional[array] = array("Q")
+        self.registers: Optional[bytearray] = None
+    
+    @staticmethod
+    def hash(value) -> int:
+        return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "little")
+    
+    def add(self, value):
+        h = self.hash(value)
+        if self.hashes is not None:
+            position = bisect_left(self.hashes, h)
+            if position < len(self.hashes) and self.hashes[position] == h:
+                return
+            self.hashes.insert(position, h)
+            if len(self.hashes) > (1 << self.precision) // 8:
+                self._densify()
+            return
+        self._update(h)
+    
+    def _update(self, h: int):
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def _densify(self):
+        self.registers = bytearray(1 << self.precision)
+        for h in self.hashes:
+            self._update(h)
+        self.hashes = None
+    
+    def count(self) -> int:
+        if self.hashes is not None:
+            return len(self.hashes)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # поправка для малых значений
+        return round(estimate)
+    
+    def to_str(self) -> str:
+        """s: — хэши, d: — регистры; base64, little-endian"""
+        if self.hashes is not None:
+            return "s:" + UserTable._pack(self.hashes)
+        return f"d{self.precision}:" + base64.b64encode(bytes(self.registers)).decode("ascii")
+    
+    @classmethod
+    def from_str(cls, packed: str) -> "HyperLogLog":
+        mode, _, body = packed.partition(":")
+        if mode == "s":
+            sketch = cls()
+            sketch.hashes = UserTable._unpack("Q", body)
+            return sketch
+        sketch = cls(int(mode[1:]))
+        sketch.hashes = None
+        sketch.registers = bytearray(base64.b64decode(body))
+        return sketch
+
 # Модель для статистики
 class Statistics:
     def __init__(self):
-        self.file_path = STATS_FILE
+        self.file_path = STATS_SNAPSHOT_FILE
+        self.legacy_file_path = STATS_FILE
+        self.users = UserTable()
+        self.viewers: Dict[str, HyperLogLog] = {}
+        self.view_dedupe = ViewDedupe(VIEW_DEDUPE_WINDOW, VIEW_DEDUPE_LIMIT)
         self.data = self.load_data()
+        self.dirty = False
     
     def load_data(self) -> dict:
-        """Загрузка статистики из файла"""
-        default_data = {
+        """Загрузка статистики; пользователи переносятся в колоночную таблицу self.users"""
+        path = self.legacy_file_path if os.path.exists(self.legacy_file_path) else self.file_path
+        try:
+            data = self._read_data()
+            users = UserTable.from_data(data)
+            viewers = {
+                material_id: HyperLogLog.from_str(packed)
+                for material_id, packed in data.pop("material_viewers", {}).items()
+            }
+        except Exception as e:
+            # Нечитаемый файл откладывается: иначе первое сохранение заменит его пустой статистикой.
+            # Если отложить не удалось, исключение останавливает запуск
+            if not os.path.exists(path):
+                path = self.file_path  # statistics.json уже сконвертирован, ошибка в снимке
+            aside = f"{path}.corrupt-{datetime.datetime.now():%Y%m%d-%H%M%S}"
+            os.replace(path, aside)
+            logger.critical("❌ Не удалось прочитать статистику %s (%s), файл перемещен в %s", path, e, aside)
+            data = self._read_data()
+            users = UserTable.from_data(data)
+            viewers = {}
+        self.users = users
+        self.viewers = viewers
+        data["total_users"] = len(self.users)
+        return data
+    
+    def _read_data(self) -> dict:
+        """Чтение снимка (с конвертацией из statistics.json); без файлов — пустая статистика"""
+        if os.path.exists(self.legacy_file_path):
+            return self.convert_legacy_json()
+        if os.path.exists(self.file_path):
+            return StatsSnapshot.load(self.file_path)
+        return {
             "total_users": 0,
-            "active_users": [],
             "daily_stats": {},
             "material_views": {},
-            "subject_views": {},
-            "user_actions": {}
+            "subject_views": {}
         }
-        try:
-            if os.path.exists(self.file_path):
-                with open(self.file_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-        except Exception as e:
-            print(f"❌ Ошибка загрузки статистики: {e}")
-        return default_data
+    
+    def payload(self) -> dict:
+        """Данные для снимка: словарь статистики, столбцы таблицы пользователей и скетчи зрителей"""
+        return {
+            **self.data,
+            "user_table": self.users.to_dict(),
+            "material_viewers": {material_id: sketch.to_str() for material_id, sketch in self.viewers.items()},
+        }
+    
+    def convert_legacy_json(self) -> dict:
+        """Перенос statistics.json в снимок, исходный файл сохраняется как .bak"""
+        with open(self.legacy_file_path, "rb") as f:
+            data = DataManager.loads(f.read())
+        StatsSnapshot.save(data, self.file_path)
+        os.replace(self.legacy_file_path, f"{self.legacy_file_path}.bak")
+        logger.info("✅ Статистика сконвертирована в %s", self.file_path)
+        return data
     
     def save_data(self):
-        """Сохранение статистики в файл"""
+        """Сохранение статистики в снимок"""
         try:
-            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(self.data, f, indent=2, ensure_ascii=False)
+            StatsSnapshot.save(self.payload(), self.file_path)
+            self.dirty = False
             return True
         except Exception as e:
-            print(f"❌ Ошибка сохранения статистики: {e}")
+            logger.error("❌ Ошибка сохранения статистики: %s", e)
             return False
     
+    def schedule_save(self):
+        """Отложенное сохранение: накопленные изменения пишет задача планировщика statistics_flush"""
+        self.dirty = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_data()
+    
+    async def flush(self):
+        """Записать изменения одним снимком, если они есть"""
+        if not self.dirty:
+            return
+        # Флаг снимается до записи, чтобы изменения, сделанные во время нее, попали в следующий снимок
+        self.dirty = False
+        try:
+            # Кодирование на цикле событий: данные меняются только в нем; запись файла — в потоке
+            payload = StatsSnapshot.encode(self.payload())
+            await asyncio.to_thread(StatsSnapshot.write, payload, self.file_path)
+        except BaseException:
+            self.dirty = True
+            raise
+    
     def register_user(self, user_id: int):
         """Регистрация пользователя"""
         today = datetime.date.today().isoformat()
         user_id_str = str(user_id)
         
         # Общая статистика
-        if user_id_str not in self.data["active_users"]:
-            self.data["active_users"].append(user_id_str)
-        
-        self.data["total_users"] = len(self.data["active_users"])
+        self.users.ensure(user_id, UserTable.day(today))
+        self.data["total_users"] = len(self.users)
         
         # Дневная статистика
         if today not in self.data["daily_stats"]:
             self.data["daily_stats"][today] = {
                 "new_users": 0,
                 "active_users": [],
-                "actions": 0
+                "actions": 0,
+                "material_views": {},
+                "subject_views": {}
             }
         
         daily = self.data["daily_stats"][today]
@@ -162,25 +1290,38 @@ class Statistics:
             daily["new_users"] += 1
             daily["active_users"].append(user_id_str)
         
-        self.save_data()
+        self.schedule_save()
     
     def register_action(self, user_id: int, action_type: str, target: str = None):
         """Регистрация действия пользователя"""
+        # Повторное открытие материала в окне не увеличивает просмотры, но остается действием пользователя
+        counted = True
+        if action_type == "material_view" and target and self.view_dedupe.seen(user_id, target):
+            metrics.inc("material_views_deduped")
+            counted = False
+        
         today = datetime.date.today().isoformat()
-        user_id_str = str(user_id)
         
         # Регистрируем пользователя
         self.register_user(user_id)
         
         # Обновляем дневную статистику
-        if today in self.data["daily_stats"]:
-            self.data["daily_stats"][today]["actions"] += 1
+        daily = self.data["daily_stats"].get(today)
+        if daily:
+            daily["actions"] += 1
+            # Просмотры по дням нужны для графиков динамики
+            if action_type in ("material_view", "subject_view") and target and counted:
+                day_views = daily.setdefault(f"{action_type.split('_')[0]}_views", {})
+                day_views[target] = day_views.get(target, 0) + 1
         
         # Статистика по материалам
-        if action_type == "material_view" and target:
+        if action_type == "material_view" and target and counted:
             if target not in self.data["material_views"]:
                 self.data["material_views"][target] = 0
             self.data["material_views"][target] += 1
+            if target not in self.viewers:
+                self.viewers[target] = HyperLogLog()
+            self.viewers[target].add(user_id)
         
         # Статистика по предметам
         if action_type == "subject_view" and target:
@@ -189,23 +1330,9 @@ class Statistics:
             self.data["subject_views"][target] += 1
         
         # Статистика по пользователям
-        if user_id_str not in self.data["user_actions"]:
-            self.data["user_actions"][user_id_str] = {
-                "first_seen": today,
-                "last_seen": today,
-                "total_actions": 0,
-                "action_types": {}
-            }
-        
-        user_stats = self.data["user_actions"][user_id_str]
-        user_stats["last_seen"] = today
-        user_stats["total_actions"] += 1
+        self.users.add_action(user_id, UserTable.day(today), action_type)
         
-        if action_type not in user_stats["action_types"]:
-            user_stats["action_types"][action_type] = 0
-        user_stats["action_types"][action_type] += 1
-        
-        self.save_data()
+        self.schedule_save()
     
     def get_daily_stats(self, days: int = 7) -> List[dict]:
         """Получить статистику за последние N дней"""
@@ -241,7 +1368,15 @@ class Statistics:
             key=lambda x: x[1],
             reverse=True
         )[:limit]
-        return [{"material_id": mat_id, "views": views} for mat_id, views in materials]
+        return [
+            {"material_id": mat_id, "views": views, "viewers": self.get_unique_viewers(mat_id)}
+            for mat_id, views in materials
+        ]
+    
+    def get_unique_viewers(self, material_id: str) -> int:
+        """Оценка числа уникальных зрителей (точная, пока их меньше 2^p / 8)"""
+        sketch = self.viewers.get(material_id)
+        return sketch.count() if sketch else 0
     
     def get_popular_subjects(self) -> List[dict]:
         """Получить статистику по предметам"""
@@ -250,6 +1385,43 @@ class Statistics:
             for subject, views in self.data["subject_views"].items()
         ]
     
+    # Генераторы для выгрузки: история не копируется, строки читаются по одной
+    def iter_user_actions(self):
+        """(user_id, first_seen, last_seen, total_actions, action_type, count) — строка на тип действия"""
+        users = self.users
+        for row in range(len(users)):
+            user_stats = users.record(row)
+            for action_type, count in user_stats["action_types"].items():
+                yield (
+                    str(users.user_ids[row]), user_stats["first_seen"], user_stats["last_seen"],
+                    user_stats["total_actions"], action_type, count
+                )
+    
+    def iter_daily_stats(self):
+        """(date, new_users, active_users, actions) по дням"""
+        daily_stats = self.data["daily_stats"]
+        for date_str in sorted(daily_stats):
+            daily = daily_stats.get(date_str)
+            if daily:
+                yield date_str, daily["new_users"], len(daily["active_users"]), daily["actions"]
+    
+    def iter_material_views(self):
+        """(material_id, views, viewers) по материалам"""
+        material_views = self.data["material_views"]
+        for material_id in list(material_views):
+            yield material_id, material_views.get(material_id, 0), self.get_unique_viewers(material_id)
+    
+    def prune_daily_stats(self, keep_days: int) -> int:
+        """Удалить дневную статистику старше keep_days дней, вернуть число удаленных дней"""
+        cutoff = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+        stale = [date_str for date_str in self.data["daily_stats"] if date_str < cutoff]
+        for date_str in stale:
+            del self.data["daily_stats"][date_str]
+        if stale:
+            self.schedule_save()
+            logger.info("🗑 Удалена дневная статистика за %s дн. (старше %s)", len(stale), cutoff)
+        return len(stale)
+    
     def get_active_users_count_today(self) -> int:
         """Получить количество активных пользователей сегодня"""
         today = datetime.date.today().isoformat()
@@ -259,93 +1431,268 @@ class Statistics:
 
 # Функции работы с данными
 class DataManager:
+    @staticmethod
+    def dumps(data, pretty: bool = False) -> bytes:
+        """JSON в UTF-8: orjson, если установлен, иначе стандартный json"""
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+        if pretty:
+            return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    
+    @staticmethod
+    def loads(payload):
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(bytes(payload))
+    
     @staticmethod
     def load_json(file_path: str, default=None):
         if default is None:
             default = {}
         try:
             if os.path.exists(file_path):
-                with open(file_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
+                with open(file_path, "rb") as f:
+                    return DataManager.loads(f.read())
         except Exception as e:
-            print(f"Ошибка загрузки {file_path}: {e}")
+            logger.error("Ошибка загрузки %s: %s", file_path, e)
         return default
     
     @staticmethod
-    def save_json(data, file_path: str):
+    def save_json(data, file_path: str, pretty: bool = True):
+        """Атомарная запись; pretty=False — без отступов для служебных файлов"""
         try:
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            tmp_path = f"{file_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(DataManager.dumps(data, pretty))
+            os.replace(tmp_path, file_path)
             return True
         except Exception as e:
-            print(f"Ошибка сохранения {file_path}: {e}")
+            logger.error("Ошибка сохранения %s: %s", file_path, e)
             return False
 
 class MaterialManager:
+    """Каталог материалов: чтение из памяти, все изменения через одну задачу-писателя"""
     def __init__(self):
         self.file_path = MATERIALS_FILE
+        self._materials: Optional[Dict[str, dict]] = None
+        self._signature = None
+        # id -> (запись каталога, Material): объект пересоздается, только если запись заменена
+        self._objects: Dict[str, tuple] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._listeners = []
+    
+    def subscribe(self, listener):
+        """Подписка на закоммиченные изменения: listener(список затронутых записей)"""
+        self._listeners.append(listener)
+    
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
     
     def get_all_materials(self) -> Dict[str, dict]:
-        return DataManager.load_json(self.file_path, {})
+        """Закоммиченное состояние каталога (не изменять, файл перечитывается при ручной правке)"""
+        signature = self._file_signature()
+        if self._materials is None or signature != self._signature:
+            self._materials = self.migrate(DataManager.load_json(self.file_path, {}))
+            self._signature = signature
+            self._objects.clear()
+        return self._materials
     
-    def save_materials(self, materials: Dict[str, dict]):
-        return DataManager.save_json(materials, self.file_path)
+    @staticmethod
+    def migrate(raw: dict) -> Dict[str, dict]:
+        """Каталог из файла любой поддерживаемой версии схемы"""
+        if "schema_version" not in raw:
+            return raw  # версия 1: материалы без обертки
+        if raw["schema_version"] > MATERIALS_SCHEMA_VERSION:
+            raise ValueError(f"неподдерживаемая версия каталога: {raw['schema_version']}")
+        return raw["materials"]
     
-    def add_material(self, material: Material) -> bool:
-        materials = self.get_all_materials()
-        materials[material.id] = material.to_dict()
-        return self.save_materials(materials)
+    def save_materials(self, materials: Dict[str, dict]):
+        return DataManager.save_json({"schema_version": MATERIALS_SCHEMA_VERSION, "materials": materials}, self.file_path)
+    
+    def _material(self, material_data: dict) -> Material:
+        """Кэшированный Material для записи каталога"""
+        cached = self._objects.get(material_data["id"])
+        if cached is not None and cached[0] is material_data:
+            return cached[1]
+        material = Material.from_dict(material_data)
+        self._objects[material_data["id"]] = (material_data, material)
+        return material
+    
+    async def add_material(self, material: Material) -> bool:
+        return await self.add_materials([material])
+    
+    async def add_materials(self, materials: List[Material]) -> bool:
+        """Добавить несколько материалов одной записью на диск"""
+        ok, _ = await self._submit([("add", material.to_dict()) for material in materials])
+        return ok
+    
+    async def delete_material(self, material_id: str) -> bool:
+        return await self.delete_materials([material_id]) > 0
+    
+    async def delete_materials(self, material_ids: List[str]) -> int:
+        """Удалить несколько материалов одной записью на диск, вернуть число удаленных"""
+        ok, deleted = await self._submit([("delete", material_id) for material_id in material_ids])
+        return deleted if ok else 0
+    
+    async def _submit(self, operations: list):
+        """Поставить транзакцию в очередь писателя и дождаться коммита"""
+        if self._writer is None or self._writer.done():
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.create_task(self._writer_loop())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((operations, future))
+        return await future
+    
+    async def _writer_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._commit(batch)
+            except Exception as e:
+                logger.exception("❌ Ошибка записи каталога: %s", e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result((False, 0))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    async def _commit(self, batch: list):
+        """Применить все транзакции пачки к копии каталога и записать ее один раз"""
+        materials = dict(self.get_all_materials())
+        removed_files = []
+        touched = []
+        changes = []
+        for operations, _ in batch:
+            changed = 0
+            for action, payload in operations:
+                if action == "add":
+                    if payload["id"] in materials:
+                        touched.append(materials[payload["id"]])
+                    materials[payload["id"]] = payload
+                    touched.append(payload)
+                    changed += 1
+                elif action == "delete":
+                    material_data = materials.pop(payload, None)
+                    self._objects.pop(payload, None)
+                    if material_data:
+                        touched.append(material_data)
+                        changed += 1
+                        if material_data.get("file_path"):
+                            removed_files.append(os.path.join(MEDIA_DIR, material_data["file_path"]))
+            changes.append(changed)
+        
+        ok = True
+        if any(changes):
+            ok = await asyncio.to_thread(self.save_materials, materials)
+            if ok:
+                self._materials = materials
+                self._signature = self._file_signature()
+                await asyncio.to_thread(self._remove_files, removed_files)
+                for listener in self._listeners:
+                    try:
+                        listener(touched)
+                    except Exception as e:
+                        logger.exception("❌ Ошибка обработчика изменений каталога: %s", e)
+        
+        for (_, future), changed in zip(batch, changes):
+            if not future.done():
+                future.set_result((ok, changed))
     
-    def delete_material(self, material_id: str) -> bool:
-        materials = self.get_all_materials()
-        if material_id in materials:
-            if materials[material_id].get("file_path"):
-                try:
-                    file_path = os.path.join(MEDIA_DIR, materials[material_id]["file_path"])
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        print(f"✅ Файл {file_path} удален")
-                except Exception as e:
-                    print(f"Ошибка удаления файла: {e}")
-            del materials[material_id]
-            return self.save_materials(materials)
-        return False
+    @staticmethod
+    def _remove_files(file_paths: List[str]):
+        for file_path in file_paths:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                    logger.info("✅ Файл %s удален", file_path)
+            except Exception as e:
+                logger.error("Ошибка удаления файла: %s", e)
+    
+    async def close(self):
+        """Дождаться записи всех поставленных транзакций и остановить писателя"""
+        if self._writer is None:
+            return
+        await self._queue.join()
+        self._writer.cancel()
+        self._writer = None
     
     def get_material(self, material_id: str) -> Optional[Material]:
         materials = self.get_all_materials()
         material_data = materials.get(material_id)
-        return Material.from_dict(material_data) if material_data else None
+        return self._material(material_data) if material_data else None
     
     def get_materials_by_subject(self, subject: str) -> List[Material]:
         materials = self.get_all_materials()
-        return [Material.from_dict(mat) for mat in materials.values() 
+        return [self._material(mat) for mat in materials.values() 
                 if mat.get("subject") == subject]
     
     def get_materials_by_subject_and_group(self, subject: str, group: str) -> List[Material]:
         materials = self.get_all_materials()
         if group == "all":
-            return [Material.from_dict(mat) for mat in materials.values() 
+            return [self._material(mat) for mat in materials.values() 
                     if mat.get("subject") == subject]
-        return [Material.from_dict(mat) for mat in materials.values() 
+        return [self._material(mat) for mat in materials.values() 
                 if mat.get("subject") == subject and mat.get("group") == group]
     
     def get_materials_by_subject_and_type(self, subject: str, material_type: str) -> List[Material]:
         """Получить материалы по предмету и типу материала"""
         materials = self.get_all_materials()
-        return [Material.from_dict(mat) for mat in materials.values() 
+        return [self._material(mat) for mat in materials.values() 
                 if mat.get("subject") == subject and mat.get("material_type") == material_type]
     
+    @staticmethod
+    def material_section_key(material_data: dict) -> Optional[str]:
+        """Ключ раздела, в котором показывается материал"""
+        subject_key = next((key for key, name in SUBJECTS.items() if name == material_data.get("subject")), None)
+        if not subject_key:
+            return None
+        if subject_key == "информатика" or not material_data.get("material_type"):
+            return MaterialManager.section_key(subject_key, group=material_data.get("group") or "all")
+        return MaterialManager.section_key(subject_key, material_type=material_data["material_type"])
+    
+    @staticmethod
+    def section_key(subject_key: str, group: str = None, material_type: str = None) -> str:
+        """Компактный ключ раздела для callback_data (лимит 64 байта): предмет:g:группа или предмет:t:индекс типа"""
+        if material_type is None:
+            return f"{subject_key}:g:{group}"
+        types = SUBJECT_TYPES.get(subject_key, ["📚 Лекции"])
+        index = types.index(material_type) if material_type in types else 0
+        return f"{subject_key}:t:{index}"
+    
+    def get_section(self, section_key: str):
+        """Название и материалы раздела по ключу, None для неизвестного ключа"""
+        try:
+            subject_key, kind, value = section_key.split(":", 2)
+            subject_name = SUBJECTS[subject_key]
+            if kind == "g":
+                title = f"{subject_name} — группа {value}" if value != "all" else f"{subject_name} — лекции"
+                return title, self.get_materials_by_subject_and_group(subject_name, value)
+            material_type = SUBJECT_TYPES.get(subject_key, ["📚 Лекции"])[int(value)]
+            return f"{subject_name} — {material_type}", self.get_materials_by_subject_and_type(subject_name, material_type)
+        except (ValueError, KeyError, IndexError):
+            return None
+    
     def get_recent_materials(self, limit: int = 10) -> List[Material]:
         materials = self.get_all_materials()
         sorted_materials = sorted(materials.values(), 
                                key=lambda x: x.get("date_added", ""), 
                                reverse=True)
-        return [Material.from_dict(mat) for mat in sorted_materials[:limit]]
+        return [self._material(mat) for mat in sorted_materials[:limit]]
 
 # Инициализация менеджеров
 material_manager = MaterialManager()
 statistics = Statistics()
+scheduler.add("statistics_flush", IntervalTrigger(STATS_FLUSH_DELAY), statistics.flush, persist=False)
 
 # Клавиатуры
 class KeyboardManager:
@@ -367,6 +1714,7 @@ class KeyboardManager:
         """Главное меню админ-панели"""
         builder = InlineKeyboardBuilder()
         builder.button(text="➕ Добавить материал", callback_data="add_material")
+        builder.button(text="📦 Импорт из ZIP", callback_data="import_zip")
         builder.button(text="🗑 Управление материалами", callback_data="manage_materials")
         builder.button(text="📊 Статистика", callback_data="admin_stats")
         builder.button(text="⬅️ В главное меню", callback_data="main_menu")
@@ -381,10 +1729,45 @@ class KeyboardManager:
         builder.button(text="📈 Детальная статистика", callback_data="detailed_stats")
         builder.button(text="👥 Активность пользователей", callback_data="users_stats")
         builder.button(text="📚 Популярные материалы", callback_data="popular_materials")
+        builder.button(text="🖼 Графики", callback_data="charts_menu")
+        builder.button(text="📐 Когорты и удержание", callback_data="cohort_stats")
+        builder.button(text="⚙️ Состояние системы", callback_data="system_stats")
+        builder.button(text="📤 Экспорт данных", callback_data="export_menu")
         builder.button(text="⬅️ В админ-панель", callback_data="admin_panel")
         builder.adjust(1)
         return builder
     
+    @staticmethod
+    def charts_keyboard() -> InlineKeyboardBuilder:
+        """Выбор графика и периода"""
+        builder = InlineKeyboardBuilder()
+        for chart, title in ChartManager.CHARTS.items():
+            for days in ChartManager.RANGES:
+                builder.button(text=f"{title} · {days} дн.", callback_data=f"chart:{chart}:{days}")
+        builder.button(text="⬅️ Назад", callback_data="admin_stats")
+        builder.adjust(len(ChartManager.RANGES))
+        return builder
+    
+    @staticmethod
+    def export_keyboard() -> InlineKeyboardBuilder:
+        """Выбор выгружаемых данных"""
+        builder = InlineKeyboardBuilder()
+        for dataset, (title, _) in StatsExporter.DATASETS.items():
+            builder.button(text=title, callback_data=f"export:{dataset}")
+        builder.button(text="⬅️ Назад", callback_data="admin_stats")
+        builder.adjust(1)
+        return builder
+    
+    @staticmethod
+    def export_formats_keyboard(dataset: str) -> InlineKeyboardBuilder:
+        """Выбор формата выгрузки"""
+        builder = InlineKeyboardBuilder()
+        for fmt in StatsExporter.available_formats():
+            builder.button(text=f"📄 {fmt.upper()}", callback_data=f"export_run:{dataset}:{fmt}")
+        builder.button(text="⬅️ Назад", callback_data="export_menu")
+        builder.adjust(3, 1)
+        return builder
+    
     @staticmethod
     def admin_subjects_keyboard() -> InlineKeyboardBuilder:
         """Клавиатура выбора предмета для админа"""
@@ -473,12 +1856,16 @@ class KeyboardManager:
         return builder
     
     @staticmethod
-    def materials_list_keyboard(materials: List[Material]) -> InlineKeyboardBuilder:
+    def materials_list_keyboard(materials: List[Material], section_key: str = None) -> InlineKeyboardBuilder:
         builder = InlineKeyboardBuilder()
         
         for material in materials:
             builder.button(text=material.title, callback_data=f"material:{material.id}")
         
+        if section_key:
+            builder.button(text="📥 Скачать все", callback_data=f"send_all:{section_key}")
+            builder.button(text="🗜 Архив раздела", callback_data=f"bundle:{section_key}")
+        
         builder.button(text="⬅️ Назад", callback_data="back_to_materials_list")
         builder.adjust(1)
         return builder
@@ -491,90 +1878,1203 @@ class KeyboardManager:
         if user_id in ADMIN_IDS:
             builder.button(text="🗑 Удалить", callback_data=f"delete_confirm:{material_id}")
         
-        builder.adjust(1)
-        return builder
-    
-    @staticmethod
-    def manage_materials_keyboard(materials: List[Material]) -> InlineKeyboardBuilder:
-        builder = InlineKeyboardBuilder()
+        builder.adjust(1)
+        return builder
+    
+    @staticmethod
+    def manage_materials_keyboard(materials: List[Material]) -> InlineKeyboardBuilder:
+        builder = InlineKeyboardBuilder()
+        
+        for material in materials:
+            builder.button(text=f"🗑 {material.title}", callback_data=f"delete_material:{material.id}")
+        
+        builder.button(text="⬅️ Назад", callback_data="admin_panel")
+        builder.adjust(1)
+        return builder
+
+# Исправленная система работы с файлами
+class FileManager:
+    @staticmethod
+    async def save_media_file(message: Message, file_prefix: str) -> Optional[str]:
+        """Сохранение файлов"""
+        try:
+            if message.document:
+                media = message.document
+                file_ext = os.path.splitext(message.document.file_name)[1]
+                file_name = f"{file_prefix}{file_ext}"
+                kind = "Документ сохранен"
+            elif message.photo:
+                media = message.photo[-1]
+                file_name = f"{file_prefix}_photo.jpg"
+                kind = "Фото сохранено"
+            elif message.video:
+                media = message.video
+                file_name = f"{file_prefix}_video.mp4"
+                kind = "Видео сохранено"
+            else:
+                return None
+            
+            if media.file_size and media.file_size > MAX_DOWNLOAD_SIZE:
+                logger.warning("❌ Файл больше %s МБ: %s байт", MAX_DOWNLOAD_SIZE // (1024 * 1024), media.file_size)
+                return None
+            
+            file_path = os.path.join(MEDIA_DIR, file_name)
+            await FileManager.fetch_file(media.file_id, file_path)
+            logger.info("✅ %s: %s", kind, file_path)
+            return file_name
+                
+        except Exception as e:
+            logger.error("❌ Ошибка сохранения файла: %s", e)
+        return None
+    
+    @staticmethod
+    async def fetch_file(file_id: str, destination: str):
+        """Скачивание файла; с локальным сервером — жесткая ссылка или копия его файла"""
+        if BOT_API_LOCAL:
+            file = await bot.get_file(file_id)
+            source = str(bot.session.api.wrap_local_file.to_local(file.file_path))
+            if os.path.isabs(source) and os.path.exists(source):
+                await asyncio.to_thread(FileManager._link_or_copy, source, destination)
+                return
+        await bot.download(file_id, destination=destination, timeout=int(HTTP_FILE_TIMEOUT))
+    
+    @staticmethod
+    def _link_or_copy(source: str, destination: str):
+        """Жесткая ссылка на файл локального сервера, иначе копия; исходный файл не перемещается"""
+        try:
+            os.link(source, destination)
+        except OSError:
+            # Другая файловая система или запрет жестких ссылок: копия, файл остается в кэше сервера
+            shutil.copy2(source, destination)
+    
+    @staticmethod
+    def input_file(full_path: str, filename: Optional[str] = None):
+        """Файл для отправки: путь file:// для локального сервера (имя берется из пути), иначе потоковая загрузка"""
+        if BOT_API_LOCAL:
+            server_path = bot.session.api.wrap_local_file.to_server(os.path.abspath(full_path))
+            return f"file://{server_path}"
+        return FSInputFile(full_path, filename=filename)
+    
+    @staticmethod
+    async def save_media_files(messages: List[Message], file_prefixes: List[str]) -> List[Optional[str]]:
+        """Параллельное сохранение файлов альбома с ограничением числа одновременных загрузок"""
+        semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        
+        async def save(message: Message, file_prefix: str) -> Optional[str]:
+            async with semaphore:
+                return await FileManager.save_media_file(message, file_prefix)
+        
+        return await asyncio.gather(*(
+            save(message, file_prefix) for message, file_prefix in zip(messages, file_prefixes)
+        ))
+    
+    # file_id уже загруженных файлов: повторная отправка без загрузки
+    _file_ids: Dict[str, str] = {}
+    
+    @staticmethod
+    def media_kind(file_path: str) -> str:
+        if file_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+            return "photo"
+        if file_path.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
+            return "video"
+        return "document"
+    
+    @staticmethod
+    def media_source(file_path: str):
+        """file_id, если файл уже загружался, иначе FSInputFile/file:// путь; None — файл недоступен"""
+        if file_path in FileManager._file_ids:
+            return FileManager._file_ids[file_path]
+        
+        full_path = os.path.join(MEDIA_DIR, file_path)
+        if not os.path.exists(full_path):
+            logger.warning("❌ Файл не найден: %s", full_path)
+            return None
+        
+        if os.path.getsize(full_path) > MAX_UPLOAD_SIZE:
+            logger.warning("❌ Файл больше %s МБ: %s", MAX_UPLOAD_SIZE // (1024 * 1024), full_path)
+            return None
+        
+        # FSInputFile или file:// путь для локального сервера
+        return FileManager.input_file(full_path)
+    
+    @staticmethod
+    def remember_file_id(file_path: str, message):
+        """Запомнить file_id из отправленного или отредактированного сообщения"""
+        if not isinstance(message, Message):
+            return
+        media = getattr(message, FileManager.media_kind(file_path))
+        if isinstance(media, list):
+            media = media[-1] if media else None
+        if media:
+            FileManager._file_ids[file_path] = media.file_id
+    
+    @staticmethod
+    def input_media(file_path: str, caption: str = ""):
+        """InputMedia для edit_message_media; None — файл недоступен"""
+        source = FileManager.media_source(file_path)
+        if source is None:
+            return None
+        media_types = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+        return media_types[FileManager.media_kind(file_path)](media=source, caption=caption)
+    
+    @staticmethod
+    async def send_media_file(chat_id: int, file_path: str, caption: str = "", reply_markup=None):
+        """Отправка файлов с использованием FSInputFile или сохраненного file_id"""
+        try:
+            source = FileManager.media_source(file_path)
+            if source is None:
+                return False
+            
+            log_sampled("📤 Отправка файла: %s", file_path)
+            
+            kind = FileManager.media_kind(file_path)
+            if kind == "photo":
+                message = await bot.send_photo(chat_id, source, caption=caption, reply_markup=reply_markup)
+            elif kind == "video":
+                message = await bot.send_video(chat_id, source, caption=caption, reply_markup=reply_markup)
+            else:
+                message = await bot.send_document(chat_id, source, caption=caption, reply_markup=reply_markup)
+            FileManager.remember_file_id(file_path, message)
+            
+            log_sampled("✅ Файл успешно отправлен: %s", file_path)
+            return True
+            
+        except Exception as e:
+            logger.error("❌ Ошибка отправки файла: %s", e)
+            FileManager._file_ids.pop(file_path, None)
+            return False
+
+# Сбор альбомов (media group), которые Telegram присылает отдельными сообщениями
+class AlbumCollector:
+    def __init__(self):
+        self._albums: Dict[str, dict] = {}
+        self._tasks = set()
+    
+    def add(self, message: Message, state: FSMContext):
+        """Добавить сообщение альбома и перезапустить таймер ожидания остальных"""
+        key = f"{message.chat.id}:{message.media_group_id}"
+        album = self._albums.setdefault(key, {"messages": [], "state": state, "timer": None})
+        album["messages"].append(message)
+        if album["timer"]:
+            album["timer"].cancel()
+        album["timer"] = asyncio.get_running_loop().call_later(ALBUM_DEBOUNCE, self._flush, key)
+    
+    def _flush(self, key: str):
+        album = self._albums.pop(key, None)
+        if not album:
+            return
+        messages = sorted(album["messages"], key=lambda message: message.message_id)
+        task = asyncio.create_task(process_album(messages, album["state"]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+album_collector = AlbumCollector()
+
+# Массовый импорт материалов из ZIP-архива
+class ZipImporter:
+    """Импорт архива: манифест (manifest.csv / manifest.json) или структура папок предмет/группа/файл"""
+    MANIFEST_NAMES = ("manifest.csv", "manifest.json")
+    PROGRESS_INTERVAL = 2.0
+    
+    @staticmethod
+    def resolve_subject(value: str) -> Optional[str]:
+        """Ключ предмета по ключу или названию из SUBJECTS"""
+        value = (value or "").strip().lower()
+        for key, name in SUBJECTS.items():
+            if value in (key, name.lower()):
+                return key
+        return None
+    
+    @staticmethod
+    def resolve_type(subject_key: str, value: str) -> str:
+        """Тип материала по тексту без учета эмодзи, по умолчанию лекции"""
+        value = (value or "").strip().lower()
+        types = SUBJECT_TYPES.get(subject_key, ["📚 Лекции"])
+        for material_type in types:
+            if value and (value == material_type.lower() or value in material_type.lower()):
+                return material_type
+        return types[0]
+    
+    @staticmethod
+    def member_name(info: zipfile.ZipInfo) -> str:
+        """Имя файла в архиве; архиваторы Windows пишут кириллицу в cp866 без флага UTF-8"""
+        if info.flag_bits & 0x800:
+            return info.filename
+        try:
+            return info.filename.encode("cp437").decode("cp866")
+        except UnicodeError:
+            return info.filename
+    
+    @classmethod
+    def read_manifest(cls, archive: zipfile.ZipFile) -> Dict[str, dict]:
+        """Манифест: имя файла в архиве -> поля материала"""
+        members = {info.filename.lower(): info for info in archive.infolist()}
+        for manifest_name in cls.MANIFEST_NAMES:
+            if manifest_name not in members:
+                continue
+            with archive.open(members[manifest_name]) as f:
+                text = io.TextIOWrapper(f, encoding="utf-8-sig")
+                if manifest_name.endswith(".csv"):
+                    rows = list(csv.DictReader(text))
+                else:
+                    rows = json.load(text)
+                    if isinstance(rows, dict):
+                        rows = [dict(fields, file=file_name) for file_name, fields in rows.items()]
+            return {row["file"].strip(): row for row in rows if row.get("file")}
+        return {}
+    
+    @classmethod
+    def plan(cls, archive: zipfile.ZipFile, manifest: Dict[str, dict]):
+        """Сопоставить файлы архива с материалами, вернуть (задания, пропуски)"""
+        jobs = []
+        skipped = []
+        listed = set()
+        for info in archive.infolist():
+            name = cls.member_name(info)
+            base_name = os.path.basename(name)
+            if info.is_dir() or not base_name or base_name.startswith(".") or name.startswith("__MACOSX/"):
+                continue
+            if name.lower() in cls.MANIFEST_NAMES:
+                continue
+            
+            extension = os.path.splitext(base_name)[1].lower()
+            if extension not in ALLOWED_EXTENSIONS:
+                skipped.append(f"{name}: недопустимый тип файла")
+                continue
+            if info.file_size > MAX_UPLOAD_SIZE:
+                skipped.append(f"{name}: файл больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ")
+                continue
+            
+            row = manifest.get(name, {})
+            if row:
+                listed.add(name)
+            folders = name.split("/")[:-1]
+            subject_key = cls.resolve_subject(row.get("subject") or (folders[0] if folders else ""))
+            if not subject_key:
+                skipped.append(f"{name}: не указан предмет")
+                continue
+            
+            section = row.get("group") or row.get("type") or (folders[1] if len(folders) > 1 else "")
+            if subject_key == "информатика":
+                group = section.strip()
+                if group not in INFORMATICS_GROUPS:
+                    skipped.append(f"{name}: неизвестная группа '{group}'")
+                    continue
+                material_type = ""
+            else:
+                group = "all"
+                material_type = cls.resolve_type(subject_key, row.get("type") or section)
+            
+            jobs.append({
+                "info": info,
+                "material_id": str(uuid.uuid4())[:8],
+                "title": (row.get("title") or os.path.splitext(base_name)[0]).strip(),
+                "subject": SUBJECTS[subject_key],
+                "group": group,
+                "material_type": material_type,
+                "description": (row.get("description") or "").strip(),
+                "extension": extension,
+            })
+        
+        for name in manifest:
+            if name not in listed:
+                skipped.append(f"{name}: нет в архиве")
+        return jobs, skipped
+    
+    @staticmethod
+    def extract(archive: zipfile.ZipFile, job: dict):
+        """Потоковая распаковка одного файла в MEDIA_DIR, возвращает (задание, имя файла, ошибка)"""
+        file_name = f"{job['material_id']}{job['extension']}"
+        file_path = os.path.join(MEDIA_DIR, file_name)
+        written = 0
+        try:
+            with archive.open(job["info"]) as source, open(file_path, "wb") as target:
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > MAX_UPLOAD_SIZE:
+                        raise ValueError("файл превышает допустимый размер")
+                    target.write(chunk)
+        except Exception as e:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return job, None, str(e)
+        return job, file_name, None
+    
+    @classmethod
+    async def run(cls, archive_path: str, progress: Message) -> dict:
+        """Распаковать архив пулом потоков и закоммитить все материалы одной транзакцией"""
+        loop = asyncio.get_running_loop()
+        materials = []
+        with zipfile.ZipFile(archive_path) as archive:
+            manifest = await loop.run_in_executor(None, cls.read_manifest, archive)
+            jobs, skipped = await loop.run_in_executor(None, cls.plan, archive, manifest)
+            
+            last_update = time.monotonic()
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+                futures = [loop.run_in_executor(pool, cls.extract, archive, job) for job in jobs]
+                for done, future in enumerate(asyncio.as_completed(futures), 1):
+                    job, file_name, error = await future
+                    if error:
+                        skipped.append(f"{cls.member_name(job['info'])}: {error}")
+                    else:
+                        materials.append(Material(
+                            material_id=job["material_id"],
+                            title=job["title"],
+                            subject=job["subject"],
+                            group=job["group"],
+                            material_type=job["material_type"],
+                            description=job["description"],
+                            file_path=file_name
+                        ))
+                    
+                    if time.monotonic() - last_update >= cls.PROGRESS_INTERVAL:
+                        last_update = time.monotonic()
+                        try:
+                            await progress.edit_text(f"📦 Импорт: обработано {done} из {len(jobs)} файлов...")
+                        except Exception as e:
+                            logger.warning("❌ Ошибка обновления прогресса: %s", e)
+        
+        if not materials:
+            return {"added": 0, "failed": False, "skipped": skipped}
+        
+        committed = await material_manager.add_materials(materials)
+        if not committed:
+            await asyncio.to_thread(MaterialManager._remove_files, [
+                os.path.join(MEDIA_DIR, material.file_path) for material in materials
+            ])
+        return {
+            "added": len(materials) if committed else 0,
+            "failed": not committed,
+            "skipped": skipped,
+        }
+
+# Отправка всего раздела пачками send_media_group
+class SectionSender:
+    def __init__(self):
+        self._active: Dict[int, asyncio.Task] = {}
+    
+    def start(self, chat_id: int, title: str, materials: List[Material]) -> bool:
+        """Запустить фоновую отправку, не больше одной на чат"""
+        task = self._active.get(chat_id)
+        if task and not task.done():
+            return False
+        task = asyncio.create_task(self._deliver(chat_id, title, materials))
+        self._active[chat_id] = task
+        task.add_done_callback(lambda done: self._forget(chat_id, done))
+        return True
+    
+    def _forget(self, chat_id: int, task: asyncio.Task):
+        if self._active.get(chat_id) is task:
+            del self._active[chat_id]
+    
+    async def _deliver(self, chat_id: int, title: str, materials: List[Material]):
+        # Проверка файлов на диске — в потоке; уже загружавшиеся файлы уходят по file_id
+        prepared = await asyncio.to_thread(self._prepare, materials)
+        # Документы нельзя смешивать с фото и видео в одном альбоме
+        documents = [item for item in prepared if isinstance(item[1], InputMediaDocument)]
+        visual = [item for item in prepared if not isinstance(item[1], InputMediaDocument)]
+        batches = [
+            group[start:start + MEDIA_GROUP_SIZE]
+            for group in (visual, documents)
+            for start in range(0, len(group), MEDIA_GROUP_SIZE)
+        ]
+        sent = 0
+        try:
+            for i, batch in enumerate(batches):
+                if i:
+                    await asyncio.sleep(SEND_ALL_INTERVAL)
+                sent += await self._send_batch(chat_id, batch)
+            await bot.send_message(chat_id, f"✅ {title}: отправлено файлов {sent} из {len(materials)}")
+        except Exception as e:
+            logger.error("❌ Ошибка отправки раздела: %s", e)
+            await MessageUtils.safe_send_message(chat_id, f"⚠️ Отправка прервана, отправлено файлов: {sent}")
+    
+    @staticmethod
+    def _prepare(materials: List[Material]) -> List[tuple]:
+        """(материал, InputMedia) для доступных файлов: file_id из кэша или загрузка с диска"""
+        prepared = []
+        for material in materials:
+            if not material.file_path:
+                continue
+            media = FileManager.input_media(material.file_path, material.title)
+            if media is not None:
+                prepared.append((material, media))
+        return prepared
+    
+    @classmethod
+    async def _send_batch(cls, chat_id: int, batch: List[tuple]) -> int:
+        """Отправить пачку альбомом (один файл — отдельным сообщением); возвращает число отправленных файлов"""
+        retried = False
+        while True:
+            try:
+                if len(batch) == 1:
+                    material, media = batch[0]
+                    send = {"photo": bot.send_photo, "video": bot.send_video}.get(media.type, bot.send_document)
+                    messages = [await send(chat_id, media.media, caption=material.title)]
+                else:
+                    messages = await bot.send_media_group(chat_id, [media for _, media in batch])
+                for (material, _), message in zip(batch, messages):
+                    FileManager.remember_file_id(material.file_path, message)
+                return len(batch)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                # Устаревший file_id в пачке: забываем file_id этих файлов и один раз загружаем их заново
+                if retried:
+                    raise
+                retried = True
+                for material, _ in batch:
+                    FileManager._file_ids.pop(material.file_path, None)
+                batch = await asyncio.to_thread(cls._prepare, [material for material, _ in batch])
+                if not batch:
+                    return 0
+
+section_sender = SectionSender()
+
+# Готовые ZIP-архивы разделов с кэшированной ссылкой Telegram
+class BundleManager:
+    def __init__(self):
+        self.index_path = BUNDLES_INDEX_FILE
+        self.index: Dict[str, dict] = DataManager.load_json(self.index_path, {})
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._build_slot: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        # Разделы, чьи записи изменены в памяти, но еще не записаны в bundles.json
+        self._unsaved = set()
+        os.makedirs(BUNDLES_DIR, exist_ok=True)
+    
+    def on_catalog_change(self, touched: List[dict]):
+        """Сбросить ссылки затронутых архивов и пересобрать их в фоне"""
+        for section_key in {MaterialManager.material_section_key(data) for data in touched}:
+            entry = self.index.get(section_key)
+            if not entry:
+                continue
+            entry["file_id"] = None
+            self._unsaved.add(section_key)
+            task = asyncio.create_task(self.ensure(section_key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    @staticmethod
+    def _safe_name(text: str, fallback: str) -> str:
+        return "".join("_" if char in '\\/:*?"<>|' else char for char in text).strip() or fallback
+    
+    @classmethod
+    def _arcname(cls, material: Material, used: set) -> str:
+        title = cls._safe_name(material.title, material.id)
+        arcname = f"{title}{os.path.splitext(material.file_path)[1]}"
+        if arcname in used:
+            arcname = f"{title} ({material.id}){os.path.splitext(material.file_path)[1]}"
+        used.add(arcname)
+        return arcname
+    
+    def _desired_members(self, materials: List[Material]) -> Dict[str, dict]:
+        members = {}
+        used = set()
+        for material in sorted(materials, key=lambda m: m.date_added or ""):
+            if not material.file_path:
+                continue
+            try:
+                stat = os.stat(os.path.join(MEDIA_DIR, material.file_path))
+            except OSError:
+                continue
+            members[material.id] = {
+                "file": material.file_path,
+                "arcname": self._arcname(material, used),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+            }
+        return members
+    
+    @staticmethod
+    def _build(bundle_path: str, members: Dict[str, dict], previous: Dict[str, dict]):
+        """Дописать новые файлы в существующий архив или пересобрать его, если файлы удалены/изменены"""
+        unchanged = all(members.get(material_id) == member for material_id, member in previous.items())
+        os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+        # Архив собирается во временном файле рядом и подменяется атомарно: отправка не увидит недописанный zip
+        tmp_path = f"{bundle_path}.tmp"
+        if previous and unchanged and os.path.exists(bundle_path):
+            shutil.copyfile(bundle_path, tmp_path)
+            with zipfile.ZipFile(tmp_path, "a", zipfile.ZIP_STORED) as archive:
+                for material_id, member in members.items():
+                    if material_id not in previous:
+                        archive.write(os.path.join(MEDIA_DIR, member["file"]), member["arcname"])
+        else:
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as archive:
+                for member in members.values():
+                    archive.write(os.path.join(MEDIA_DIR, member["file"]), member["arcname"])
+        os.replace(tmp_path, bundle_path)
+    
+    async def ensure(self, section_key: str) -> Optional[dict]:
+        """Актуальный архив раздела (собирается только при изменении состава)"""
+        section = material_manager.get_section(section_key)
+        if not section:
+            return None
+        title, materials = section
+        
+        lock = self._locks.setdefault(section_key, asyncio.Lock())
+        async with lock:
+            # Папка по хэшу раздела, имя архива по названию: с локальным сервером документ получает имя файла
+            entry = self.index.get(section_key) or {
+                "file": f"{hashlib.sha1(section_key.encode('utf-8')).hexdigest()[:16]}/{self._safe_name(title, 'materials')}.zip",
+                "members": {},
+                "file_id": None,
+            }
+            bundle_path = os.path.join(BUNDLES_DIR, entry["file"])
+            members = await asyncio.to_thread(self._desired_members, materials)
+            changed = section_key in self._unsaved or self.index.get(section_key) is not entry or entry.get("title") != title
+            if members != entry["members"] or not os.path.exists(bundle_path):
+                if self._build_slot is None:
+                    self._build_slot = asyncio.Semaphore(1)
+                async with self._build_slot:
+                    await asyncio.to_thread(self._build, bundle_path, members, entry["members"])
+                entry["members"] = members
+                entry["file_id"] = None
+                changed = True
+            entry["title"] = title
+            self.index[section_key] = entry
+            if changed:
+                await self._save(section_key)
+            return entry
+    
+    async def _save(self, section_key: str):
+        self._unsaved.discard(section_key)
+        await asyncio.to_thread(DataManager.save_json, self.index, self.index_path, False)
+    
+    async def send(self, chat_id: int, section_key: str) -> bool:
+        """Отправить архив: по кэшированному file_id одним вызовом, иначе загрузкой файла"""
+        entry = await self.ensure(section_key)
+        if not entry or not entry["members"]:
+            return False
+        
+        if entry["file_id"]:
+            try:
+                await bot.send_document(chat_id, entry["file_id"], caption=f"🗜 {entry['title']}")
+                return True
+            except TelegramBadRequest as e:
+                # file_id устарел или отозван: забываем его и загружаем архив заново
+                logger.warning("⚠️ file_id архива %s отклонен (%s), повторная загрузка", section_key, e)
+                if entry["file_id"]:
+                    entry["file_id"] = None
+                    await self._save(section_key)
+        
+        bundle_path = os.path.join(BUNDLES_DIR, entry["file"])
+        if os.path.getsize(bundle_path) > MAX_UPLOAD_SIZE:
+            raise ValueError("архив превышает лимит загрузки")
+        message = await bot.send_document(
+            chat_id,
+            FileManager.input_file(bundle_path, filename=f"{entry['title']}.zip"),
+            caption=f"🗜 {entry['title']}"
+        )
+        if message.document and self.index.get(section_key) is entry and entry["file_id"] is None:
+            entry["file_id"] = message.document.file_id
+            await self._save(section_key)
+        return True
+
+bundle_manager = BundleManager()
+material_manager.subscribe(bundle_manager.on_catalog_change)
+
+# Сборщик медиафайлов, на которые не ссылается каталог
+class MediaSweeper:
+    """Инкрементальный обход MEDIA_DIR: сирота сначала уходит в карантин и удаляется после GC_QUARANTINE_TTL"""
+    def __init__(self):
+        self.index_path = QUARANTINE_INDEX_FILE
+        self.quarantine: Dict[str, dict] = DataManager.load_json(self.index_path, {})
+        self.last_report: Optional[dict] = None
+        self._catalog = None
+        self._referenced_files = set()
+        os.makedirs(QUARANTINE_DIR, exist_ok=True)
+    
+    def _referenced(self) -> set:
+        """Имена файлов каталога (множество пересобирается только после изменения каталога)"""
+        materials = material_manager.get_all_materials()
+        if materials is not self._catalog:
+            self._catalog = materials
+            self._referenced_files = {data["file_path"] for data in materials.values() if data.get("file_path")}
+        return self._referenced_files
+    
+    @staticmethod
+    def _scan_chunk(iterator, limit: int) -> list:
+        """Следующие limit файлов директории: (имя, размер, mtime)"""
+        chunk = []
+        for entry in iterator:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            chunk.append((entry.name, stat.st_size, stat.st_mtime))
+            if len(chunk) >= limit:
+                break
+        return chunk
+    
+    @staticmethod
+    def _quarantine_files(names: List[str]) -> List[str]:
+        moved = []
+        for name in names:
+            try:
+                os.replace(os.path.join(MEDIA_DIR, name), os.path.join(QUARANTINE_DIR, name))
+                moved.append(name)
+            except OSError as e:
+                logger.error("Ошибка переноса %s в карантин: %s", name, e)
+        return moved
+    
+    @staticmethod
+    def _restore_files(names: List[str]) -> List[str]:
+        """Вернуть файлы, на которые снова ссылается каталог (живой файл в MEDIA_DIR не перезаписывается)"""
+        restored = []
+        for name in names:
+            source = os.path.join(QUARANTINE_DIR, name)
+            target = os.path.join(MEDIA_DIR, name)
+            try:
+                if os.path.exists(target):
+                    os.remove(source)
+                else:
+                    os.replace(source, target)
+                restored.append(name)
+            except FileNotFoundError:
+                restored.append(name)
+            except OSError as e:
+                logger.error("Ошибка восстановления %s из карантина: %s", name, e)
+        return restored
+    
+    @staticmethod
+    def _delete_files(names: List[str]):
+        deleted = []
+        reclaimed = 0
+        for name in names:
+            file_path = os.path.join(QUARANTINE_DIR, name)
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                reclaimed += size
+                deleted.append(name)
+            except FileNotFoundError:
+                deleted.append(name)
+            except OSError as e:
+                logger.error("Ошибка удаления %s: %s", file_path, e)
+        return deleted, reclaimed
+    
+    async def sweep(self) -> dict:
+        """Один проход: разбор карантина, обход MEDIA_DIR пачками, очистка старой статистики"""
+        started = time.perf_counter()
+        now = time.time()
+        report = {"scanned": 0, "quarantined": 0, "restored": 0, "deleted": 0, "reclaimed_bytes": 0}
+        
+        referenced = self._referenced()
+        restore = [name for name in self.quarantine if name in referenced]
+        expired = [
+            name for name, entry in self.quarantine.items()
+            if name not in referenced and now - entry["since"] >= GC_QUARANTINE_TTL
+        ]
+        for name in await asyncio.to_thread(self._restore_files, restore):
+            self.quarantine.pop(name, None)
+            report["restored"] += 1
+        deleted, reclaimed = await asyncio.to_thread(self._delete_files, expired)
+        for name in deleted:
+            self.quarantine.pop(name, None)
+        report["deleted"] = len(deleted)
+        report["reclaimed_bytes"] = reclaimed
+        
+        iterator = await asyncio.to_thread(os.scandir, MEDIA_DIR)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(self._scan_chunk, iterator, GC_SCAN_BATCH)
+                if not chunk:
+                    break
+                report["scanned"] += len(chunk)
+                # Каталог перепроверяется на каждой пачке: учитываются материалы, добавленные во время обхода
+                referenced = self._referenced()
+                orphans = {
+                    name: size for name, size, mtime in chunk
+                    if name not in referenced and now - mtime >= GC_GRACE_PERIOD
+                }
+                if orphans:
+                    for name in await asyncio.to_thread(self._quarantine_files, list(orphans)):
+                        self.quarantine[name] = {"since": now, "size": orphans[name]}
+                        report["quarantined"] += 1
+                await asyncio.sleep(GC_SCAN_PAUSE)
+        finally:
+            iterator.close()
+        
+        await asyncio.to_thread(DataManager.save_json, dict(self.quarantine), self.index_path, False)
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        report["finished_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        self.last_report = report
+        
+        metrics.inc("gc_quarantined_files", report["quarantined"])
+        metrics.inc("gc_deleted_files", report["deleted"])
+        metrics.inc("gc_reclaimed_bytes", report["reclaimed_bytes"])
+        metrics.observe("gc_sweep_ms", report["duration_ms"])
+        logger.info(
+            "🧹 Очистка медиа: просмотрено %s, в карантин %s, восстановлено %s, удалено %s (%.1f МБ)",
+            report["scanned"], report["quarantined"], report["restored"], report["deleted"],
+            report["reclaimed_bytes"] / 1024 / 1024
+        )
+        return report
+
+media_sweeper = MediaSweeper()
+scheduler.add("media_gc", IntervalTrigger(GC_INTERVAL), media_sweeper.sweep, jitter=GC_JITTER, start_delay=GC_START_DELAY)
+scheduler.add("stats_prune", CronTrigger(STATS_PRUNE_CRON), lambda: statistics.prune_daily_stats(STATS_RETENTION_DAYS))
+
+# Потоковая выгрузка статистики в файл
+class StatsExporter:
+    DATASETS = {
+        "user_actions": ("👥 Действия пользователей", [
+            ("user_id", "str"), ("first_seen", "str"), ("last_seen", "str"),
+            ("total_actions", "int"), ("action_type", "str"), ("count", "int"),
+        ]),
+        "daily_stats": ("📅 Статистика по дням", [
+            ("date", "str"), ("new_users", "int"), ("active_users", "int"), ("actions", "int"),
+        ]),
+        "material_views": ("📚 Просмотры материалов", [
+            ("material_id", "str"), ("title", "str"), ("subject", "str"), ("views", "int"), ("viewers", "int"),
+        ]),
+    }
+    FORMATS = {"csv": ".csv.gz", "jsonl": ".jsonl.gz", "parquet": ".parquet"}
+    
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+    
+    @staticmethod
+    def available_formats() -> List[str]:
+        return [fmt for fmt in StatsExporter.FORMATS if fmt != "parquet" or pyarrow is not None]
+    
+    @staticmethod
+    def rows(dataset: str):
+        if dataset == "user_actions":
+            return statistics.iter_user_actions()
+        if dataset == "daily_stats":
+            return statistics.iter_daily_stats()
+        materials = material_manager.get_all_materials()
+        return (
+            (material_id, materials.get(material_id, {}).get("title", ""),
+             materials.get(material_id, {}).get("subject", ""), views, viewers)
+            for material_id, views, viewers in statistics.iter_material_views()
+        )
+    
+    @staticmethod
+    def _chunks(rows):
+        while True:
+            chunk = list(islice(rows, EXPORT_CHUNK_ROWS))
+            if not chunk:
+                return
+            yield chunk
+    
+    @classmethod
+    def write(cls, dataset: str, fmt: str, file_path: str) -> int:
+        """Записать выборку в файл порциями по EXPORT_CHUNK_ROWS строк, вернуть число строк"""
+        columns = cls.DATASETS[dataset][1]
+        names = [name for name, _ in columns]
+        total = 0
+        if fmt == "parquet":
+            types = {"str": pyarrow.string(), "int": pyarrow.int64()}
+            schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+            with pyarrow.parquet.ParquetWriter(file_path, schema, compression="zstd") as writer:
+                for chunk in cls._chunks(cls.rows(dataset)):
+                    arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+                    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                    total += len(chunk)
+            return total
+        
+        with gzip.open(file_path, "wt", encoding="utf-8", newline="") as f:
+            if fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(names)
+            for chunk in cls._chunks(cls.rows(dataset)):
+                if fmt == "csv":
+                    writer.writerows(chunk)
+                else:
+                    f.writelines(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n" for row in chunk)
+                total += len(chunk)
+        return total
+    
+    async def send(self, chat_id: int, dataset: str, fmt: str) -> int:
+        """Сформировать файл в потоке и отправить документом; выгрузки выполняются по одной"""
+        title = self.DATASETS[dataset][0]
+        file_name = f"{dataset}_{datetime.date.today().isoformat()}{self.FORMATS[fmt]}"
+        async with self._lock:
+            # Внутри static/: папку должен видеть и локальный сервер Bot API
+            export_dir = tempfile.mkdtemp(prefix="export-", dir=EXPORTS_DIR)
+            try:
+                file_path = os.path.join(export_dir, file_name)
+                total = await asyncio.to_thread(self.write, dataset, fmt, file_path)
+                if os.path.getsize(file_path) > MAX_UPLOAD_SIZE:
+                    raise ValueError("файл превышает лимит загрузки")
+                await bot.send_document(
+                    chat_id,
+                    FileManager.input_file(file_path, filename=file_name),
+                    caption=f"📤 {title}: {total} строк"
+                )
+                return total
+            finally:
+                await asyncio.to_thread(shutil.rmtree, export_dir, True)
+
+stats_exporter = StatsExporter()
+
+# Когорты и вовлеченность: столбцы NumPy строятся из статистики раз в сутки
+class CohortAnalytics:
+    def __init__(self):
+        self._cache: Dict[str, dict] = {}
+        self._lock = asyncio.Lock()
+    
+    async def get(self) -> Optional[dict]:
+        """Отчет за сегодня (без numpy возвращает None)"""
+        if np is None:
+            return None
+        today = datetime.date.today().isoformat()
+        async with self._lock:
+            if today not in self._cache:
+                report = await asyncio.to_thread(
+                    self.compute, statistics.data, statistics.users.columns(), material_manager.get_all_materials()
+                )
+                self._cache = {today: report}
+        return self._cache[today]
+    
+    @staticmethod
+    def _user_columns(columns: dict):
+        """Отсортированные id пользователей, день первого визита (дни от эпохи) и число действий"""
+        user_ids = np.frombuffer(columns["user_ids"], dtype=np.int64)
+        first_day = np.frombuffer(columns["first_seen"], dtype=np.int32).astype(np.int64)
+        total_actions = np.frombuffer(columns["total_actions"], dtype=np.uint32).astype(np.int64)
+        order = np.argsort(user_ids)
+        return user_ids[order], first_day[order], total_actions[order]
+    
+    @staticmethod
+    def _activity_columns(daily_stats: dict, user_ids: "np.ndarray"):
+        """Пары (индекс пользователя, день) из дневной активности"""
+        active = []
+        days = []
+        counts = []
+        for date_str in list(daily_stats):
+            day_users = list(daily_stats[date_str]["active_users"])
+            active.extend(day_users)
+            days.append(np.datetime64(date_str, "D").astype(np.int64))
+            counts.append(len(day_users))
+        if not active or not len(user_ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        active_ids = np.fromiter(map(int, active), dtype=np.int64, count=len(active))
+        active_days = np.repeat(np.array(days, dtype=np.int64), counts)
+        position = np.minimum(np.searchsorted(user_ids, active_ids), len(user_ids) - 1)
+        known = user_ids[position] == active_ids
+        return position[known], active_days[known]
+    
+    @staticmethod
+    def _views_by(labels: list, views: "np.ndarray") -> List[dict]:
+        """Сумма просмотров и число материалов по меткам"""
+        if not labels:
+            return []
+        names, codes = np.unique(np.array(labels), return_inverse=True)
+        totals = np.bincount(codes, weights=views)
+        counts = np.bincount(codes)
+        order = np.argsort(-totals)
+        return [
+            {"label": str(names[i]), "materials": int(counts[i]), "views": int(totals[i])}
+            for i in order
+        ]
+    
+    @classmethod
+    def compute(cls, data: dict, columns: dict, materials: dict) -> dict:
+        started = time.perf_counter()
+        weeks = COHORT_WEEKS
+        today = np.datetime64(datetime.date.today().isoformat(), "D").astype(np.int64)
+        
+        user_ids, first_day, total_actions = cls._user_columns(columns)
+        active_user, active_day = cls._activity_columns(data["daily_stats"], user_ids)
+        
+        # Когорта — понедельник недели первого визита (1970-01-01 — четверг)
+        cohort_day = first_day - (first_day + 3) % 7
+        first_cohort = today - (today + 3) % 7 - 7 * (weeks - 1)
+        in_range = cohort_day >= first_cohort
+        cohort_idx = np.where(in_range, (cohort_day - first_cohort) // 7, -1)
+        sizes = np.bincount(cohort_idx[in_range], minlength=weeks)
+        
+        # Неделя N — дни [7N, 7N + 7) от первого визита; пользователь учитывается в неделе один раз
+        offsets = (active_day - first_day[active_user]) // 7
+        valid = (offsets >= 0) & (offsets < weeks) & in_range[active_user]
+        pairs = np.unique(active_user[valid] * weeks + offsets[valid])
+        returned = np.bincount(
+            cohort_idx[pairs // weeks] * weeks + pairs % weeks, minlength=weeks * weeks
+        ).reshape(weeks, weeks)
+        
+        cohorts = []
+        for i in range(weeks):
+            start = first_cohort + 7 * i
+            # Неделя N доступна, только если она целиком прошла для всей когорты
+            elapsed = (today - start - 6) // 7
+            rates = [
+                round(float(returned[i, n]) / sizes[i] * 100, 1) if sizes[i] and n <= elapsed else None
+                for n in range(1, weeks)
+            ]
+            cohorts.append({
+                "week": str(np.datetime64(int(start), "D")),
+                "size": int(sizes[i]),
+                "rates": rates,
+            })
+        
+        engagement = {"users": int(len(total_actions))}
+        if len(total_actions):
+            engagement.update({
+                "mean": float(total_actions.mean()),
+                "median": float(np.median(total_actions)),
+                "p90": float(np.percentile(total_actions, 90)),
+                "engaged_share": float((total_actions >= 10).mean() * 100),
+            })
         
-        for material in materials:
-            builder.button(text=f"🗑 {material.title}", callback_data=f"delete_material:{material.id}")
+        material_views = data["material_views"]
+        group_labels, group_views, type_labels, type_views = [], [], [], []
+        for material_id in list(materials):
+            material_data = materials[material_id]
+            views = material_views.get(material_id, 0)
+            group = material_data.get("group")
+            if group and group != "all":
+                group_labels.append(f"{material_data.get('subject', '')} · {group}")
+                group_views.append(views)
+            if material_data.get("material_type"):
+                type_labels.append(material_data["material_type"])
+                type_views.append(views)
         
-        builder.button(text="⬅️ Назад", callback_data="admin_panel")
-        builder.adjust(1)
-        return builder
+        return {
+            "cohorts": cohorts,
+            "engagement": engagement,
+            "groups": cls._views_by(group_labels, np.array(group_views, dtype=np.float64)),
+            "types": cls._views_by(type_labels, np.array(type_views, dtype=np.float64)),
+            "computed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
 
-# Исправленная система работы с файлами
-class FileManager:
-    @staticmethod
-    async def save_media_file(message: Message, file_prefix: str) -> Optional[str]:
-        """Сохранение файлов"""
-        try:
-            if message.document:
-                file_ext = os.path.splitext(message.document.file_name)[1]
-                file_name = f"{file_prefix}{file_ext}"
-                file_path = os.path.join(MEDIA_DIR, file_name)
-                await bot.download(message.document, destination=file_path)
-                print(f"✅ Документ сохранен: {file_path}")
-                return file_name
-            
-            elif message.photo:
-                file_name = f"{file_prefix}_photo.jpg"
-                file_path = os.path.join(MEDIA_DIR, file_name)
-                await bot.download(message.photo[-1], destination=file_path)
-                print(f"✅ Фото сохранено: {file_path}")
-                return file_name
-            
-            elif message.video:
-                file_name = f"{file_prefix}_video.mp4"
-                file_path = os.path.join(MEDIA_DIR, file_name)
-                await bot.download(message.video, destination=file_path)
-                print(f"✅ Видео сохранено: {file_path}")
-                return file_name
-                
-        except Exception as e:
-            print(f"❌ Ошибка сохранения файла: {e}")
-        return None
+cohort_analytics = CohortAnalytics()
+
+# Графики статистики: отрисовка в пуле процессов, повторная отправка по file_id
+class ChartManager:
+    CHARTS = {
+        "active_users": "Активные пользователи",
+        "new_users": "Новые пользователи",
+        "actions": "Действия",
+        "subjects": "Просмотры по предметам",
+        "materials": "Просмотры популярных материалов",
+    }
+    RANGES = (7, 30)
     
-    @staticmethod
-    async def send_media_file(chat_id: int, file_path: str, caption: str = ""):
-        """Отправка файлов с использованием FSInputFile"""
-        try:
-            full_path = os.path.join(MEDIA_DIR, file_path)
-            
-            if not os.path.exists(full_path):
-                print(f"❌ Файл не найден: {full_path}")
-                return False
-            
-            print(f"📤 Отправка файла: {full_path}")
-            
-            # Используем FSInputFile вместо InputFile
-            if file_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                await bot.send_photo(chat_id, FSInputFile(full_path), caption=caption)
-            elif file_path.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                await bot.send_video(chat_id, FSInputFile(full_path), caption=caption)
+    def __init__(self):
+        self._executor: Optional[Executor] = None
+        # (график, дней) -> (версия данных, file_id)
+        self._file_ids: Dict[tuple, tuple] = {}
+        self._locks: Dict[tuple, asyncio.Lock] = {}
+    
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            if __name__ == "__main__":
+                # python py.py: воркеры forkserver/spawn повторно выполнили бы весь модуль бота
+                logger.warning("⚠️ Бот запущен как python py.py, графики рисуются в потоке; используйте python main.py")
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="charts")
+                return self._executor
+            # fork из многопоточного процесса может унаследовать захваченные блокировки,
+            # поэтому воркеры запускаются через forkserver, предзагрузивший только charts
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["charts"])
             else:
-                await bot.send_document(chat_id, FSInputFile(full_path), caption=caption)
-            
-            print("✅ Файл успешно отправлен!")
-            return True
+                context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=context, initializer=charts.check_worker)
+        return self._executor
+    
+    async def close(self):
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown, wait=True, cancel_futures=True)
+            self._executor = None
+    
+    @classmethod
+    def build_spec(cls, chart: str, days: int) -> dict:
+        """Данные графика за последние days дней"""
+        today = datetime.date.today()
+        dates = [(today - datetime.timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+        daily_stats = statistics.data["daily_stats"]
+        days_data = [daily_stats.get(date_str, {}) for date_str in dates]
+        labels = [date_str[5:] for date_str in dates]
+        title = f"{cls.CHARTS[chart]} за {days} дн."
+        
+        if chart == "active_users":
+            values = [len(daily.get("active_users", [])) for daily in days_data]
+            return {"kind": "line", "title": title, "labels": labels, "series": [{"name": chart, "values": values}]}
+        if chart in ("new_users", "actions"):
+            values = [daily.get(chart, 0) for daily in days_data]
+            return {"kind": "line", "title": title, "labels": labels, "series": [{"name": chart, "values": values}]}
+        
+        if chart == "subjects":
+            totals = Counter()
+            for daily in days_data:
+                totals.update(daily.get("subject_views", {}))
+            top = totals.most_common(10)
+            return {
+                "kind": "bar", "title": title,
+                "labels": [name for name, _ in top],
+                "series": [{"name": chart, "values": [views for _, views in top]}],
+            }
+        
+        totals = Counter()
+        for daily in days_data:
+            totals.update(daily.get("material_views", {}))
+        series = []
+        for material_id, _ in totals.most_common(5):
+            material = material_manager.get_material(material_id)
+            name = material.title if material else material_id
+            series.append({
+                "name": name if len(name) <= 30 else f"{name[:29]}…",
+                "values": [daily.get("material_views", {}).get(material_id, 0) for daily in days_data],
+            })
+        return {"kind": "line", "title": title, "labels": labels, "series": series}
+    
+    async def send(self, chat_id: int, chart: str, days: int):
+        """Отправить график; если данные не изменились, повторно используется file_id"""
+        spec = self.build_spec(chart, days)
+        version = hashlib.sha1(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        caption = f"📈 {spec['title']}"
+        key = (chart, days)
+        
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            cached = self._file_ids.get(key)
+            if cached and cached[0] == version:
+                metrics.inc("chart_cache_hits")
+                await bot.send_photo(chat_id, cached[1], caption=caption)
+                return
             
-        except Exception as e:
-            print(f"❌ Ошибка отправки файла: {e}")
-            return False
+            started = time.perf_counter()
+            png = await asyncio.get_running_loop().run_in_executor(self._pool(), charts.render_chart, spec)
+            metrics.observe("chart_render_ms", (time.perf_counter() - started) * 1000)
+            message = await bot.send_photo(chat_id, BufferedInputFile(png, filename=f"{chart}.png"), caption=caption)
+            if message.photo:
+                self._file_ids[key] = (version, message.photo[-1].file_id)
+
+chart_manager = ChartManager()
+dp.shutdown.register(chart_manager.close)
 
 # Утилиты для работы с сообщениями
 class MessageUtils:
+    # (chat_id, message_id) -> отпечаток последнего отправленного содержимого
+    _fingerprints: "OrderedDict[tuple, int]" = OrderedDict()
+    
+    @staticmethod
+    def message_text(message) -> str:
+        """Текст сообщения или подпись медиа (карточка материала в режиме MATERIAL_INLINE_MEDIA)"""
+        return getattr(message, "text", None) or getattr(message, "caption", None) or ""
+    
+    @staticmethod
+    def fingerprint(text: str, reply_markup=None) -> int:
+        markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else ""
+        return hash((text, markup))
+    
+    @classmethod
+    def _remember(cls, key: tuple, fingerprint: int):
+        cls._fingerprints[key] = fingerprint
+        cls._fingerprints.move_to_end(key)
+        while len(cls._fingerprints) > EDIT_FINGERPRINT_LIMIT:
+            cls._fingerprints.popitem(last=False)
+    
+    @classmethod
+    def _current_fingerprint(cls, message: Message, key: tuple) -> Optional[int]:
+        """Отпечаток из кэша, иначе по содержимому сообщения из апдейта"""
+        if key in cls._fingerprints:
+            return cls._fingerprints[key]
+        if message.text is None:
+            return None
+        return cls.fingerprint(message.html_text, message.reply_markup)
+    
+    @staticmethod
+    async def _call(method):
+        """Корутина из метода Bot API, чтобы его можно было передать в asyncio.gather"""
+        return await method
+    
     @staticmethod
-    async def safe_edit_message(callback: CallbackQuery, text: str, reply_markup=None):
-        """Безопасное редактирование сообщения"""
+    async def _delete_quietly(message: Message):
+        try:
+            await message.delete()
+        except Exception as e:
+            logger.debug("Ошибка удаления сообщения: %s", e)
+    
+    # id callback-запросов, на которые уже ответил CallbackAckMiddleware
+    _acked = set()
+    
+    @classmethod
+    async def _answer_quietly(cls, callback: CallbackQuery):
+        if callback.id in cls._acked:
+            return
         try:
-            await callback.message.edit_text(text, reply_markup=reply_markup)
             await callback.answer()
         except Exception as e:
-            print(f"❌ Ошибка редактирования сообщения: {e}")
-            await callback.answer("⚠️ Произошла ошибка", show_alert=False)
+            logger.debug("Ошибка ответа на callback: %s", e)
+    
+    @classmethod
+    async def notify(cls, callback: CallbackQuery, text: str):
+        """Короткое уведомление: ответом на callback или сообщением, если ответ уже отправлен"""
+        if callback.id in cls._acked:
+            await cls.safe_send_message(callback.message.chat.id, text)
+        else:
+            await callback.answer(text)
+    
+    @classmethod
+    async def safe_edit_message(cls, callback: CallbackQuery, text: str, reply_markup=None):
+        """Редактирование сообщения: без изменений — только ответ на callback, иначе правка и ответ параллельно"""
+        message = callback.message
+        if message.text is None:
+            # Сообщение с файлом (карточка материала) нельзя превратить в текст: заменяем новым
+            await asyncio.gather(cls._delete_quietly(message), cls._answer_quietly(callback))
+            await cls.safe_send_message(message.chat.id, text, reply_markup)
+            return
+        
+        key = (message.chat.id, message.message_id)
+        fingerprint = cls.fingerprint(text, reply_markup)
+        if cls._current_fingerprint(message, key) == fingerprint:
+            metrics.inc("edits_skipped")
+            cls._remember(key, fingerprint)
+            await cls._answer_quietly(callback)
+            return
+        
+        edit_result, _ = await asyncio.gather(
+            cls._call(message.edit_text(text, reply_markup=reply_markup)),
+            cls._answer_quietly(callback),
+            return_exceptions=True
+        )
+        if isinstance(edit_result, TelegramBadRequest) and "message is not modified" in edit_result.message:
+            edit_result = None
+        if isinstance(edit_result, Exception):
+            logger.warning("❌ Ошибка редактирования сообщения: %s", edit_result)
+            cls._fingerprints.pop(key, None)
+            # На callback уже ответили, поэтому экран показываем новым сообщением
+            await cls.safe_send_message(message.chat.id, text, reply_markup)
+            return
+        cls._remember(key, fingerprint)
+    
+    @classmethod
+    async def edit_to_media(cls, callback: CallbackQuery, file_path: str, caption: str, reply_markup=None) -> bool:
+        """Превратить сообщение в сообщение с файлом и подписью; False — файл недоступен"""
+        if len(caption) > MEDIA_CAPTION_LIMIT:
+            caption = caption[:MEDIA_CAPTION_LIMIT - 1] + "…"
+        media = FileManager.input_media(file_path, caption)
+        if media is None:
+            return False
+        
+        message = callback.message
+        result, _ = await asyncio.gather(
+            cls._call(message.edit_media(media, reply_markup=reply_markup)),
+            cls._answer_quietly(callback),
+            return_exceptions=True
+        )
+        if not isinstance(result, Exception):
+            FileManager.remember_file_id(file_path, result)
+            cls._fingerprints.pop((message.chat.id, message.message_id), None)
+            return True
+        
+        # Например, устаревший file_id или сервер, не умеющий добавлять медиа к тексту
+        logger.warning("❌ Ошибка edit_message_media: %s", result)
+        FileManager._file_ids.pop(file_path, None)
+        await cls._delete_quietly(message)
+        return await FileManager.send_media_file(message.chat.id, file_path, caption, reply_markup)
     
     @staticmethod
     async def safe_send_message(chat_id: int, text: str, reply_markup=None):
@@ -583,9 +3083,202 @@ class MessageUtils:
             await bot.send_message(chat_id, text, reply_markup=reply_markup)
             return True
         except Exception as e:
-            print(f"❌ Ошибка отправки сообщения: {e}")
+            logger.error("❌ Ошибка отправки сообщения: %s", e)
             return False
 
+# Контекст логирования апдейта: update_id и user_id для всех записей при его обработке
+class UpdateLogMiddleware:
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        context = {"update_id": event.update_id, "user_id": user.id if user else None}
+        token = log_context.set(context)
+        task = watchdog.enter(dict(context))
+        try:
+            return await handler(event, data)
+        finally:
+            watchdog.leave(task)
+            log_context.reset(token)
+
+# Имя обработчика и время его работы (внутренний middleware роутера, после фильтров)
+class HandlerLogMiddleware:
+    async def __call__(self, handler, event, data: dict):
+        handler_object = data.get("handler")
+        handler_name = handler_object.callback.__name__ if handler_object else "unknown"
+        token = log_context.set({**log_context.get(), "handler": handler_name})
+        watchdog.annotate(handler=handler_name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            logger.exception("❌ Ошибка в обработчике")
+            raise
+        finally:
+            latency_ms = round((time.perf_counter() - started) * 1000, 2)
+            log_sampled("update handled", extra={"latency_ms": latency_ms})
+            log_context.reset(token)
+
+# Немедленный ответ на callback для обработчиков с флагом ack_first (до правок и загрузок)
+class CallbackAckMiddleware:
+    async def __call__(self, handler, event: CallbackQuery, data: dict):
+        if not get_flag(data, "ack_first"):
+            return await handler(event, data)
+        MessageUtils._acked.add(event.id)
+        ack = asyncio.create_task(MessageUtils._call(event.answer()))
+        try:
+            return await handler(event, data)
+        finally:
+            MessageUtils._acked.discard(event.id)
+            try:
+                await ack
+            except Exception as e:
+                logger.debug("Ошибка ответа на callback: %s", e)
+
+# Новое действие пользователя отменяет его фоновые задачи с cancel_on_navigation
+class NavigationMiddleware:
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        if user and background.cancel_user(user.id):
+            logger.debug("Фоновые задачи отменены: пользователь перешел к другому действию")
+        return await handler(event, data)
+
+# Токен-бакеты пользователей в словаре с истечением: запись удаляется, когда бакет снова полон
+class TokenBuckets:
+    def __init__(self, budgets: Dict[str, str]):
+        self.budgets = {}
+        for name, value in budgets.items():
+            capacity, rate = value.split(":")
+            self.budgets[name] = (float(capacity), float(rate))
+        # (user_id, бакет) -> [токены, время обновления, предупрежден ли]; порядок — по последнему обращению
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()
+    
+    def _expire(self, now: float):
+        while self._entries:
+            (_, name), entry = next(iter(self._entries.items()))
+            capacity, rate = self.budgets[name]
+            if entry[0] + (now - entry[1]) * rate < capacity:
+                break
+            self._entries.popitem(last=False)
+    
+    def consume(self, user_id: int, name: str):
+        """(разрешено, нужно ли предупредить пользователя)"""
+        now = time.monotonic()
+        self._expire(now)
+        capacity, rate = self.budgets[name]
+        key = (user_id, name)
+        entry = self._entries.pop(key, None) or [capacity, now, False]
+        entry[0] = min(capacity, entry[0] + (now - entry[1]) * rate)
+        entry[1] = now
+        self._entries[key] = entry
+        if entry[0] >= 1:
+            entry[0] -= 1
+            entry[2] = False
+            return True, False
+        warn = not entry[2]
+        entry[2] = True
+        return False, warn
+
+# Ограничение частоты: навигация, отправка файлов и админ-действия расходуют разные бюджеты
+class ThrottleMiddleware:
+    def __init__(self, buckets: TokenBuckets):
+        self.buckets = buckets
+    
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        # Файлы альбома приходят пачкой отдельными сообщениями
+        if user is None or (isinstance(event, Message) and event.media_group_id):
+            return await handler(event, data)
+        
+        budget = "admin" if user.id in ADMIN_IDS else get_flag(data, "throttle", default="navigation")
+        allowed, warn = self.buckets.consume(user.id, budget)
+        if allowed:
+            return await handler(event, data)
+        
+        metrics.inc(f"throttled_{budget}")
+        if isinstance(event, CallbackQuery):
+            # Ответ нужен, чтобы убрать "часики"; текст показываем один раз за серию
+            try:
+                await event.answer("🐢 Слишком часто, подождите немного" if warn else None)
+            except Exception as e:
+                logger.debug("Ошибка ответа на callback: %s", e)
+        elif warn:
+            await event.answer("🐢 Слишком много сообщений, подождите немного")
+        return None
+
+throttle_buckets = TokenBuckets(THROTTLE_BUDGETS)
+
+dp.update.outer_middleware(UpdateLogMiddleware())
+router.message.middleware(HandlerLogMiddleware())
+router.callback_query.middleware(HandlerLogMiddleware())
+router.message.middleware(ThrottleMiddleware(throttle_buckets))
+router.callback_query.middleware(ThrottleMiddleware(throttle_buckets))
+router.message.middleware(NavigationMiddleware())
+router.callback_query.middleware(NavigationMiddleware())
+router.callback_query.middleware(CallbackAckMiddleware())
+
+# Планировщик обработки апдейтов: общий лимит и очередь для каждого пользователя
+class UpdateScheduler:
+    def __init__(self, concurrency: int, user_queue_limit: int, queue_limit: int):
+        self.concurrency = concurrency
+        self.user_queue_limit = user_queue_limit
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._users: Dict[int, list] = {}  # user_id -> [lock, апдейтов в очереди]
+    
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        
+        user_entry = None
+        if user:
+            user_entry = self._users.setdefault(user.id, [asyncio.Lock(), 0])
+            # Альбом приходит пачкой сообщений и не должен упираться в лимит пользователя
+            is_album = event.message is not None and event.message.media_group_id is not None
+            if user_entry[1] >= self.user_queue_limit and not is_album:
+                return await self._shed(event, "user_queue_full")
+        if self.in_flight >= self.queue_limit:
+            return await self._shed(event, "queue_full")
+        
+        self.in_flight += 1
+        if user_entry:
+            user_entry[1] += 1
+        queued_at = time.perf_counter()
+        try:
+            if user_entry:
+                async with user_entry[0]:
+                    return await self._run(handler, event, data, queued_at)
+            return await self._run(handler, event, data, queued_at)
+        finally:
+            self.in_flight -= 1
+            if user_entry:
+                user_entry[1] -= 1
+                if user_entry[1] == 0:
+                    self._users.pop(user.id, None)
+    
+    async def _run(self, handler, event: Update, data: dict, queued_at: float):
+        async with self._semaphore:
+            metrics.observe("queue_wait_ms", (time.perf_counter() - queued_at) * 1000)
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                metrics.observe("update_handle_ms", (time.perf_counter() - started) * 1000)
+                metrics.inc("updates_handled")
+    
+    @staticmethod
+    async def _shed(event: Update, reason: str):
+        """Сброс апдейта при переполнении очереди"""
+        metrics.inc(f"updates_shed_{reason}")
+        if event.callback_query:
+            try:
+                await event.callback_query.answer("⏳ Слишком много запросов, попробуйте чуть позже")
+            except Exception as e:
+                logger.warning("❌ Ошибка ответа на колбэк: %s", e)
+        return None
+
+dp.update.outer_middleware(UpdateScheduler(UPDATE_CONCURRENCY, USER_QUEUE_LIMIT, UPDATE_QUEUE_LIMIT))
+
 # Основные команды с отслеживанием статистики
 @router.message(Command("start"))
 async def start(message: Message):
@@ -863,7 +3556,7 @@ async def popular_materials_stats(callback: CallbackQuery):
             material = material_manager.get_material(mat["material_id"])
             if material:
                 stats_text += f"{i}. {material.title}\n"
-                stats_text += f"   👀 Просмотров: {mat['views']}\n"
+                stats_text += f"   👀 Просмотров: {mat['views']}, зрителей: {mat['viewers']}\n"
                 stats_text += f"   📚 Предмет: {material.subject}\n\n"
     
     await MessageUtils.safe_edit_message(
@@ -880,12 +3573,7 @@ async def users_stats(callback: CallbackQuery):
     
     statistics.register_action(callback.from_user.id, "users_stats_view")
     
-    user_actions = statistics.data["user_actions"]
-    top_users = sorted(
-        user_actions.items(),
-        key=lambda x: x[1]["total_actions"],
-        reverse=True
-    )[:10]
+    top_users = statistics.users.top(10)
     
     stats_text = "👥 ТОП-10 АКТИВНЫХ ПОЛЬЗОВАТЕЛЕЙ\n\n"
     
@@ -904,6 +3592,191 @@ async def users_stats(callback: CallbackQuery):
         KeyboardManager.stats_keyboard().as_markup()
     )
 
+@router.callback_query(F.data == "charts_menu", flags={"ack_first": True})
+async def charts_menu_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await MessageUtils.notify(callback, "🚫 Доступ запрещен")
+        return
+    
+    if charts.plt is None:
+        await MessageUtils.notify(callback, "⚠️ Для графиков установите matplotlib")
+        return
+    
+    await MessageUtils.safe_edit_message(
+        callback,
+        "🖼 ГРАФИКИ\n\nВыберите график и период:",
+        KeyboardManager.charts_keyboard().as_markup()
+    )
+
+@router.callback_query(F.data.startswith("chart:"), flags={"ack_first": True})
+async def chart_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await MessageUtils.notify(callback, "🚫 Доступ запрещен")
+        return
+    
+    _, chart, days = callback.data.split(":")
+    if charts.plt is None or chart not in ChartManager.CHARTS or int(days) not in ChartManager.RANGES:
+        await MessageUtils.notify(callback, "❌ График недоступен")
+        return
+    
+    try:
+        await chart_manager.send(callback.message.chat.id, chart, int(days))
+    except Exception as e:
+        logger.exception("❌ Ошибка построения графика %s: %s", chart, e)
+        await callback.message.answer("❌ Не удалось построить график")
+
+@router.callback_query(F.data == "cohort_stats")
+async def cohort_stats(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("🚫 Доступ запрещен")
+        return
+    
+    report = await cohort_analytics.get()
+    if report is None:
+        await callback.answer("⚠️ Для когортного анализа установите numpy", show_alert=True)
+        return
+    
+    stats_text = "📐 КОГОРТЫ И УДЕРЖАНИЕ\n\n"
+    stats_text += f"🔁 Возвраты по неделям (W1…W{COHORT_WEEKS - 1}):\n"
+    for cohort in reversed(report["cohorts"]):
+        rates = " / ".join("—" if rate is None else f"{rate:.0f}%" for rate in cohort["rates"])
+        stats_text += f"• {cohort['week']} ({cohort['size']} чел.): {rates}\n"
+    
+    engagement = report["engagement"]
+    if engagement["users"]:
+        stats_text += (
+            f"\n👤 Действий на пользователя: медиана {engagement['median']:.0f}, "
+            f"среднее {engagement['mean']:.1f}, p90 {engagement['p90']:.0f}\n"
+            f"🔥 Вовлеченных (10+ действий): {engagement['engaged_share']:.1f}%\n"
+        )
+    
+    if report["groups"]:
+        stats_text += "\n👥 Просмотры по группам:\n"
+        for row in report["groups"]:
+            stats_text += f"• {row['label']}: {row['views']} ({row['views'] / row['materials']:.1f} на материал)\n"
+    
+    if report["types"]:
+        stats_text += "\n📂 Просмотры по типам материалов:\n"
+        for row in report["types"]:
+            stats_text += f"• {row['label']}: {row['views']} ({row['materials']} материалов)\n"
+    
+    await MessageUtils.safe_edit_message(
+        callback,
+        stats_text,
+        KeyboardManager.stats_keyboard().as_markup()
+    )
+
+@router.callback_query(F.data == "system_stats")
+async def system_stats(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("🚫 Доступ запрещен")
+        return
+    
+    snapshot = metrics.snapshot()
+    stats_text = "⚙️ СОСТОЯНИЕ СИСТЕМЫ\n\n"
+    
+    stats_text += "📊 Счетчики:\n"
+    for name, value in snapshot["counters"].items():
+        stats_text += f"• {name}: {value}\n"
+    
+    stats_text += "\n⏱ Замеры (последние значения):\n"
+    for name, summary in snapshot["samples"].items():
+        stats_text += (
+            f"• {name}: p50 {summary['p50']:.1f}, p99 {summary['p99']:.1f}, "
+            f"max {summary['max']:.1f} (n={summary['count']})\n"
+        )
+    
+    report = media_sweeper.last_report
+    if report:
+        stats_text += (
+            f"\n🧹 Очистка медиа ({report['finished_at']}):\n"
+            f"• Просмотрено файлов: {report['scanned']}\n"
+            f"• В карантине: {len(media_sweeper.quarantine)} (добавлено {report['quarantined']})\n"
+            f"• Удалено: {report['deleted']}, освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ\n"
+        )
+    
+    stall = watchdog.last_stall
+    if stall:
+        stats_text += (
+            f"\n🐢 Последняя блокировка цикла ({stall['at']}): {stall['stall_ms']:.0f} мс\n"
+            f"• Код: {html.escape(stall['where'])}\n"
+            f"• Обработчик: {stall['handler'] or stall['task'] or '—'}, апдейт {stall['update_id'] or '—'}\n"
+        )
+    
+    stats_text += "\n🗓 Периодические задачи:\n"
+    for job in scheduler.jobs.values():
+        last_run = job.last_run.strftime("%d.%m %H:%M") if job.last_run else "—"
+        next_run = job.next_run.strftime("%d.%m %H:%M") if job.next_run else "—"
+        stats_text += (
+            f"• {job.name} ({job.trigger}): последний {last_run}, {job.last_duration_ms:.0f} мс, "
+            f"следующий {next_run}, ошибок {job.failures}\n"
+        )
+        if job.last_error:
+            stats_text += f"  ⚠️ {html.escape(job.last_error)}\n"
+    
+    await MessageUtils.safe_edit_message(
+        callback,
+        stats_text,
+        KeyboardManager.stats_keyboard().as_markup()
+    )
+
+# ЭКСПОРТ СТАТИСТИКИ
+EXPORT_MENU_TEXT = "📤 ЭКСПОРТ ДАННЫХ\n\nВыберите данные для выгрузки:"
+
+@router.message(Command("export"))
+async def export_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("🚫 Доступ запрещен")
+        return
+    
+    await message.answer(EXPORT_MENU_TEXT, reply_markup=KeyboardManager.export_keyboard().as_markup())
+
+@router.callback_query(F.data == "export_menu")
+async def export_menu_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("🚫 Доступ запрещен")
+        return
+    
+    await MessageUtils.safe_edit_message(callback, EXPORT_MENU_TEXT, KeyboardManager.export_keyboard().as_markup())
+
+@router.callback_query(F.data.startswith("export:"))
+async def export_dataset_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("🚫 Доступ запрещен")
+        return
+    
+    dataset = callback.data.split(":", 1)[1]
+    if dataset not in StatsExporter.DATASETS:
+        await callback.answer("❌ Неизвестный набор данных")
+        return
+    
+    await MessageUtils.safe_edit_message(
+        callback,
+        f"📤 {StatsExporter.DATASETS[dataset][0]}\n\n"
+        "Выберите формат:\n"
+        "• CSV и JSONL — сжатые gzip\n"
+        "• PARQUET — колоночный формат для аналитики",
+        KeyboardManager.export_formats_keyboard(dataset).as_markup()
+    )
+
+@router.callback_query(F.data.startswith("export_run:"), flags={"ack_first": True})
+async def export_run_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await MessageUtils.notify(callback, "🚫 Доступ запрещен")
+        return
+    
+    _, dataset, fmt = callback.data.split(":")
+    if dataset not in StatsExporter.DATASETS or fmt not in StatsExporter.available_formats():
+        await MessageUtils.notify(callback, "❌ Формат недоступен")
+        return
+    
+    statistics.register_action(callback.from_user.id, "stats_export", dataset)
+    try:
+        await stats_exporter.send(callback.message.chat.id, dataset, fmt)
+    except Exception as e:
+        logger.exception("❌ Ошибка экспорта %s: %s", dataset, e)
+        await callback.message.answer(f"❌ Не удалось выгрузить данные: {html.escape(str(e))}")
+
 # АДМИН-ПАНЕЛЬ: Добавление материалов через кнопки
 @router.callback_query(F.data == "add_material")
 async def admin_add_material_start(callback: CallbackQuery, state: FSMContext):
@@ -1017,10 +3890,14 @@ async def admin_process_description(message: Message, state: FSMContext):
 
 @router.message(AddMaterialStates.waiting_file)
 async def admin_process_file(message: Message, state: FSMContext):
+    if message.media_group_id:
+        album_collector.add(message, state)
+        return
+    
     data = await state.get_data()
     material_id = str(uuid.uuid4())[:8]
     
-    print(f"🔍 Начало обработки файла для материала {material_id}")
+    logger.info("🔍 Начало обработки файла для материала %s", material_id)
     
     # Сохраняем файл
     file_name = await FileManager.save_media_file(message, material_id)
@@ -1040,7 +3917,7 @@ async def admin_process_file(message: Message, state: FSMContext):
         file_path=file_name
     )
     
-    if material_manager.add_material(material):
+    if await material_manager.add_material(material):
         group_info = ""
         if material.group and material.group != "all":
             group_info = f" для группы {material.group}"
@@ -1069,6 +3946,119 @@ async def admin_process_file(message: Message, state: FSMContext):
     
     await state.clear()
 
+async def process_album(messages: List[Message], state: FSMContext):
+    """Сохранение альбома: файлы качаются параллельно, материалы коммитятся одной транзакцией"""
+    first = messages[0]
+    try:
+        data = await state.get_data()
+        material_ids = [str(uuid.uuid4())[:8] for _ in messages]
+        logger.info("🔍 Начало обработки альбома из %s файлов", len(messages))
+        
+        file_names = await FileManager.save_media_files(messages, material_ids)
+        saved = [(material_id, file_name) for material_id, file_name in zip(material_ids, file_names) if file_name]
+        failed = len(messages) - len(saved)
+        
+        if not saved:
+            await first.answer("❌ Не удалось сохранить файлы альбома. Пожалуйста, попробуйте отправить их еще раз:")
+            return
+        
+        materials = [
+            Material(
+                material_id=material_id,
+                title=data['title'] if len(saved) == 1 else f"{data['title']} ({i}/{len(saved)})",
+                subject=data['subject_name'],
+                group=data.get('group', ''),
+                material_type=data.get('material_type', ''),
+                description=data['description'],
+                file_path=file_name
+            )
+            for i, (material_id, file_name) in enumerate(saved, 1)
+        ]
+        
+        if await material_manager.add_materials(materials):
+            text = f"✅ Добавлено материалов: {len(materials)}\n\n"
+            text += "\n".join(f"📚 {material.title}" for material in materials)
+            if failed:
+                text += f"\n\n⚠️ Не удалось сохранить файлов: {failed}"
+        else:
+            await asyncio.to_thread(MaterialManager._remove_files, [
+                os.path.join(MEDIA_DIR, material.file_path) for material in materials
+            ])
+            text = "❌ Ошибка при сохранении материалов."
+        
+        await first.answer(text, reply_markup=KeyboardManager.admin_panel_keyboard().as_markup())
+        await state.clear()
+    except Exception as e:
+        logger.exception("❌ Ошибка обработки альбома: %s", e)
+        await first.answer("❌ Ошибка при обработке альбома.")
+
+# АДМИН-ПАНЕЛЬ: Импорт материалов из ZIP
+@router.callback_query(F.data == "import_zip")
+async def admin_import_start(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("🚫 Доступ запрещен")
+        return
+    
+    statistics.register_action(callback.from_user.id, "import_zip_start")
+    
+    await state.set_state(ImportStates.waiting_archive)
+    await MessageUtils.safe_edit_message(
+        callback,
+        "📦 ИМПОРТ ИЗ ZIP\n\n"
+        "Отправьте ZIP-архив с материалами.\n\n"
+        "Вариант 1: manifest.csv или manifest.json в корне архива "
+        "(поля: file, title, subject, group, type, description).\n"
+        "Вариант 2: папки вида Предмет/Группа/файл или Предмет/Тип/файл, "
+        "название берется из имени файла.",
+        KeyboardManager.admin_cancel_keyboard().as_markup()
+    )
+
+@router.message(ImportStates.waiting_archive)
+async def admin_import_archive(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        await state.clear()
+        return
+    
+    document = message.document
+    if not document or not (document.file_name or "").lower().endswith(".zip"):
+        await message.answer("❌ Нужен ZIP-архив. Отправьте файл .zip:")
+        return
+    if document.file_size and document.file_size > MAX_DOWNLOAD_SIZE:
+        await message.answer(f"❌ Архив больше {MAX_DOWNLOAD_SIZE // (1024 * 1024)} МБ, Telegram не даст его скачать.")
+        return
+    
+    progress = await message.answer("📦 Импорт: загрузка архива...")
+    fd, archive_path = tempfile.mkstemp(suffix=".zip", dir="data")
+    os.close(fd)
+    try:
+        await FileManager.fetch_file(document.file_id, archive_path)
+        result = await ZipImporter.run(archive_path, progress)
+    except zipfile.BadZipFile:
+        result = None
+        await progress.edit_text("❌ Файл не является корректным ZIP-архивом.")
+    except Exception as e:
+        result = None
+        logger.exception("❌ Ошибка импорта архива: %s", e)
+        await progress.edit_text("❌ Ошибка при импорте архива.")
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+    
+    if result is None:
+        return
+    
+    statistics.register_action(message.from_user.id, "import_zip")
+    
+    text = "❌ Ошибка при сохранении материалов.\n" if result["failed"] else f"✅ Импортировано материалов: {result['added']}\n"
+    if result["skipped"]:
+        text += f"\n⚠️ Пропущено: {len(result['skipped'])}\n"
+        text += "\n".join(f"• {reason}" for reason in result["skipped"][:15])
+        if len(result["skipped"]) > 15:
+            text += f"\n… и еще {len(result['skipped']) - 15}"
+    
+    await progress.edit_text(text, reply_markup=KeyboardManager.admin_panel_keyboard().as_markup())
+    await state.clear()
+
 # Навигация в админ-панели
 @router.callback_query(F.data == "admin_add_back")
 async def admin_add_back(callback: CallbackQuery, state: FSMContext):
@@ -1148,7 +4138,7 @@ async def delete_material_callback(callback: CallbackQuery):
         await callback.answer("⚠️ Материал не найден")
         return
     
-    if material_manager.delete_material(material_id):
+    if await material_manager.delete_material(material_id):
         await MessageUtils.safe_edit_message(
             callback,
             f"✅ Материал '{material.title}' удален!",
@@ -1233,7 +4223,7 @@ async def group_materials_callback(callback: CallbackQuery):
     group = callback.data.split(":")[1]
     
     # Получаем предмет из текста сообщения
-    subject_line = callback.message.text.split('\n')[0]
+    subject_line = MessageUtils.message_text(callback.message).split('\n')[0]
     subject_key = next((key for key, name in SUBJECTS.items() if name in subject_line), None)
     
     if not subject_key:
@@ -1257,7 +4247,9 @@ async def group_materials_callback(callback: CallbackQuery):
     await MessageUtils.safe_edit_message(
         callback,
         f"📖 Материалы по {subject_name} {group_text}:",
-        KeyboardManager.materials_list_keyboard(materials).as_markup()
+        KeyboardManager.materials_list_keyboard(
+            materials, MaterialManager.section_key(subject_key, group=group)
+        ).as_markup()
     )
 
 @router.callback_query(F.data.startswith("material_type:"))
@@ -1265,7 +4257,7 @@ async def material_type_callback(callback: CallbackQuery):
     material_type = callback.data.split(":")[1]
     
     # Получаем предмет из текста сообщения
-    subject_line = callback.message.text.split('\n')[0]
+    subject_line = MessageUtils.message_text(callback.message).split('\n')[0]
     subject_key = next((key for key, name in SUBJECTS.items() if name in subject_line), None)
     
     if not subject_key:
@@ -1287,9 +4279,41 @@ async def material_type_callback(callback: CallbackQuery):
     await MessageUtils.safe_edit_message(
         callback,
         f"📖 {material_type} по {subject_name}:",
-        KeyboardManager.materials_list_keyboard(materials).as_markup()
+        KeyboardManager.materials_list_keyboard(
+            materials, MaterialManager.section_key(subject_key, material_type=material_type)
+        ).as_markup()
     )
 
+@router.callback_query(F.data.startswith("bundle:"), flags={"ack_first": True, "throttle": "files"})
+async def bundle_callback(callback: CallbackQuery):
+    section_key = callback.data.split(":", 1)[1]
+    statistics.register_action(callback.from_user.id, "bundle_download", section_key)
+    
+    try:
+        if not await bundle_manager.send(callback.from_user.id, section_key):
+            await callback.message.answer("📭 В разделе нет файлов для архива.")
+    except Exception as e:
+        logger.error("❌ Ошибка отправки архива: %s", e)
+        await callback.message.answer("⚠️ Не удалось отправить архив. Воспользуйтесь кнопкой «📥 Скачать все».")
+
+@router.callback_query(F.data.startswith("send_all:"), flags={"ack_first": True, "throttle": "files"})
+async def send_all_callback(callback: CallbackQuery):
+    section = material_manager.get_section(callback.data.split(":", 1)[1])
+    if not section:
+        await MessageUtils.notify(callback, "⚠️ Раздел не найден")
+        return
+    
+    title, materials = section
+    if not materials:
+        await MessageUtils.notify(callback, "📭 В разделе нет материалов")
+        return
+    
+    if not section_sender.start(callback.from_user.id, title, materials):
+        await MessageUtils.notify(callback, "⏳ Файлы этого раздела уже отправляются")
+        return
+    
+    statistics.register_action(callback.from_user.id, "section_download", title)
+
 @router.callback_query(F.data == "back_to_materials_list")
 async def back_to_materials_list(callback: CallbackQuery):
     # Возвращаемся к предыдущему списку материалов
@@ -1302,24 +4326,30 @@ async def back_to_materials(callback: CallbackQuery):
     # Возвращаемся к списку материалов текущего предмета/группы
     await callback.answer("Возврат к материалам...")
     # Пытаемся определить контекст из предыдущего сообщения
-    text = callback.message.text
+    text = MessageUtils.message_text(callback.message)
+    subject_key = None
     if "группы" in text:
-        # Если были в просмотре группы, возвращаемся к группам
         subject_line = text.split('\n')[0]
         subject_key = next((key for key, name in SUBJECTS.items() if name in subject_line), None)
-        if subject_key:
-            await subject_materials_callback(callback)
+    
+    if subject_key:
+        # Если были в просмотре группы, возвращаемся к группам
+        await MessageUtils.safe_edit_message(
+            callback,
+            f"📖 {SUBJECTS[subject_key]}\n\nВыберите группу:",
+            KeyboardManager.groups_keyboard(subject_key).as_markup()
+        )
     else:
         # Иначе возвращаемся к предметам
         await all_materials_callback(callback)
 
-@router.callback_query(F.data.startswith("material:"))
+@router.callback_query(F.data.startswith("material:"), flags={"ack_first": True, "throttle": "files"})
 async def material_detail_callback(callback: CallbackQuery):
     material_id = callback.data.split(":")[1]
     material = material_manager.get_material(material_id)
     
     if not material:
-        await callback.answer("⚠️ Материал не найден")
+        await MessageUtils.notify(callback, "⚠️ Материал не найден")
         return
     
     # Регистрируем просмотр материала
@@ -1328,38 +4358,46 @@ async def material_detail_callback(callback: CallbackQuery):
     group_info = f"\nГруппа: {material.group}" if material.group and material.group != "all" else ""
     type_info = f"\nТип: {material.material_type}" if material.material_type else ""
     
-    # Добавляем счетчик просмотров
+    # Счетчики просмотров: повторы в окне VIEW_DEDUPE_WINDOW не учитываются
     views = statistics.data["material_views"].get(material_id, 0)
+    viewers = statistics.get_unique_viewers(material_id)
     
     text = f"""
 📚 {material.title}
 
 Предмет: {material.subject}{group_info}{type_info}
 Дата добавления: {material.date_added}
-👀 Просмотров: {views}
+👀 Просмотров: {views}, зрителей: {viewers}
 
 {material.description or "Описание отсутствует"}
     """
     
+    keyboard = KeyboardManager.material_detail_keyboard(material_id, callback.from_user.id).as_markup()
+    
+    # Одно сообщение: файл с описанием в подписи и кнопками
+    if MATERIAL_INLINE_MEDIA and material.file_path:
+        if await MessageUtils.edit_to_media(callback, material.file_path, text.strip(), keyboard):
+            return
+    
     # Сначала отправляем текст с кнопками
-    await MessageUtils.safe_edit_message(
-        callback,
-        text,
-        KeyboardManager.material_detail_keyboard(
-            material_id, callback.from_user.id
-        ).as_markup()
-    )
+    await MessageUtils.safe_edit_message(callback, text, keyboard)
     
-    # Затем отправляем файл отдельным сообщением
+    # Затем отправляем файл отдельным сообщением в фоне: обработчик не ждет загрузку
     if material.file_path:
-        print(f"📤 Попытка отправить файл материала: {material.file_path}")
-        success = await FileManager.send_media_file(
-            callback.from_user.id, 
-            material.file_path,
-            f"📎 Файл к материалу: {material.title}"
-        )
-        if not success:
-            await callback.message.answer("⚠️ Не удалось загрузить файл. Возможно, файл был удален или поврежден.")
+        log_sampled("📤 Попытка отправить файл материала: %s", material.file_path)
+        
+        async def deliver():
+            success = await FileManager.send_media_file(
+                callback.from_user.id,
+                material.file_path,
+                f"📎 Файл к материалу: {material.title}"
+            )
+            if not success:
+                await callback.message.answer("⚠️ Не удалось загрузить файл. Возможно, файл был удален или поврежден.")
+        
+        task = background.submit(callback.from_user.id, "material_file", deliver(), cancel_on_navigation=True)
+        if task is None:
+            await callback.message.answer("⏳ Дождитесь отправки предыдущих файлов")
 
 # Команда для просмотра последних материалов
 @router.message(Command("recent"))
@@ -1453,17 +4491,23 @@ async def unknown_message(message: Message):
 
 # Запуск бота
 async def main():
-    print("🤖 Бот запущен! Для остановки нажмите Ctrl+C")
-    print(f"📁 Медиа директория: {os.path.abspath(MEDIA_DIR)}")
-    print(f"📊 Статистика: {statistics.data['total_users']} пользователей")
-    print(f"👑 Администраторы: {ADMIN_IDS}")
+    logger.info("🤖 Бот запущен! Для остановки нажмите Ctrl+C")
+    logger.info("📁 Медиа директория: %s", os.path.abspath(MEDIA_DIR))
+    logger.info("📊 Статистика: %s пользователей", statistics.data["total_users"])
+    logger.info("👑 Администраторы: %s", ADMIN_IDS)
     
     try:
         await dp.start_polling(bot)
     except KeyboardInterrupt:
-        print("\n🛑 Бот останавливается...")
-        print(f"💾 Сохранение статистики...")
+        logger.info("🛑 Бот останавливается...")
+        logger.info("💾 Сохранение статистики...")
         statistics.save_data()
+    finally:
+        await material_manager.close()
+        await background.close()
+        if statistics.dirty:
+            statistics.save_data()
 
+# Основной запуск — python main.py (см. ChartManager._pool)
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file